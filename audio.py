@@ -0,0 +1,130 @@
+"""
+Renders tone arrays straight to WAV audio, without a synth.
+
+Notes follow the midi output: one note every noteSeconds, each lasting
+noteSeconds. An oscillator bank renders one enveloped note per pitch the
+first time the pitch is used, and blocks of notes are then gathered from
+those templates and streamed to the file with the wave module, so memory is
+bounded by the block size however many notes there are.
+"""
+import wave
+
+import numpy as np
+
+SAMPLE_RATE = 44100
+# WAV chunk sizes are 32 bit
+MAX_DATA_BYTES = 0xFFFFFFFF - 36
+# noteSeconds that asks for half a second per note, shortened if needed for
+# every note to fit in a WAV file
+FIT = 'fit'
+# Relative amplitude of each harmonic, from the fundamental up
+HARMONICS = (1.0, 0.5, 0.25, 0.125)
+
+
+def midiFrequency(pitches):
+    """
+    Returns the frequency in Hz of midi note numbers
+    """
+    return 440.0 * 2.0 ** ((np.asarray(pitches, dtype=np.float64) - 69) / 12)
+
+def envelope(samples, sampleRate=SAMPLE_RATE, attack=0.01, release=0.05):
+    """
+    Returns a note envelope rising linearly over attack seconds and falling
+    to silence over the last release seconds
+    """
+    times = np.arange(samples) / sampleRate
+    rise = np.minimum(1, times / attack) if attack else 1
+    fall = np.minimum(1, (samples / sampleRate - times) / release) if release else 1
+    return rise * fall
+
+def oscillatorBank(pitches, samples, sampleRate=SAMPLE_RATE, harmonics=HARMONICS):
+    """
+    Returns a (len(pitches), samples) array with a note of each pitch, the
+    sum of the harmonics scaled to a peak of at most 1
+    """
+    times = np.arange(samples) / sampleRate
+    frequencies = midiFrequency(pitches)
+    notes = np.zeros((len(frequencies), samples))
+    for harmonic, amplitude in enumerate(harmonics, 1):
+        # Harmonics above the Nyquist frequency would alias
+        audible = frequencies * harmonic < sampleRate / 2
+        notes[audible] += amplitude * np.sin(2 * np.pi * np.outer(frequencies[audible] * harmonic, times))
+    return notes / sum(harmonics)
+
+
+def noteSecondsFor(notes, noteSeconds=FIT, sampleRate=SAMPLE_RATE):
+    """
+    Returns the seconds per note for a WAV file of notes, resolving FIT.
+    Raises ValueError if the notes will not fit in a WAV file, so the size
+    can be checked before any output is opened.
+    """
+    maxSamples = MAX_DATA_BYTES // (2 * max(notes, 1))
+    if noteSeconds == FIT:
+        noteSeconds = min(0.5, maxSamples / sampleRate)
+    samples = int(round(noteSeconds * sampleRate))
+    if samples < 1 or samples > maxSamples:
+        raise ValueError("{} notes of {} seconds are too long for a WAV file, use shorter notes".format(
+            notes, noteSeconds))
+    return noteSeconds
+
+
+class WavRenderer:
+    """
+    Streams notes to a mono 16 bit WAV file. Tones are added with addTones,
+    as often as needed, and the file is finished with close.
+    """
+
+    def __init__(self, waveFile, noteSeconds=0.5, sampleRate=SAMPLE_RATE, velocity=100, attack=0.01,
+                 release=0.05, harmonics=HARMONICS, blockBytes=16 * 1024 * 1024):
+        self.samples = int(round(noteSeconds * sampleRate))
+        self.sampleRate = sampleRate
+        self.harmonics = harmonics
+        self.envelope = envelope(self.samples, sampleRate, attack, release) * (velocity / 127) * 32767
+        self.blockNotes = max(1, blockBytes // (self.samples * 2))
+        # Rendered int16 note per midi pitch, made on first use
+        self.templates = np.zeros((128, self.samples), dtype=np.int16)
+        self.rendered = np.zeros(128, dtype=bool)
+        self.notes = 0
+
+        self.wav = wave.open(waveFile, 'wb')
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(sampleRate)
+
+    def _render(self, pitches):
+        new = np.unique(pitches)
+        new = new[~self.rendered[new]]
+        if len(new):
+            notes = oscillatorBank(new, self.samples, self.sampleRate, self.harmonics) * self.envelope
+            self.templates[new] = np.round(notes).astype(np.int16)
+            self.rendered[new] = True
+
+    def addTones(self, tones):
+        """
+        Appends a note for each midi tone, blockNotes notes at a time
+        """
+        tones = np.asarray(tones)
+        if len(tones) and (tones.min() < 0 or tones.max() > 127):
+            raise ValueError("Midi tones must be between 0 and 127")
+        if (self.notes + len(tones)) * self.samples * 2 > MAX_DATA_BYTES:
+            raise ValueError("{} notes of {} seconds are too long for a WAV file, use shorter notes".format(
+                self.notes + len(tones), self.samples / self.sampleRate))
+        for start in range(0, len(tones), self.blockNotes):
+            block = tones[start:start + self.blockNotes]
+            self._render(block)
+            self.wav.writeframes(self.templates[block].astype('<i2', copy=False).tobytes())
+        self.notes += len(tones)
+
+    def close(self):
+        self.wav.close()
+
+
+def writeWav(waveFile, tones, noteSeconds=0.5, sampleRate=SAMPLE_RATE, **options):
+    """
+    Writes a WAV file of tones, one every noteSeconds, to a path or open
+    binary file
+    """
+    noteSeconds = noteSecondsFor(len(tones), noteSeconds, sampleRate)
+    renderer = WavRenderer(waveFile, noteSeconds, sampleRate, **options)
+    renderer.addTones(tones)
+    renderer.close()
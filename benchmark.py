@@ -0,0 +1,325 @@
+"""
+Benchmarks each stage of the sonification pipeline on synthetic images.
+
+Runs grid mode at several grid sizes and pixel mode on generated greyscale
+and color images, and reports per stage wall time, pixels per second and
+peak memory. Results are saved as json and can be compared with a saved
+baseline to catch regressions. Runs offline, in a temporary folder.
+
+    python benchmark.py --sizes 1,4,12 --output bench.json
+    python benchmark.py --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import platform
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+import metrics
+import imageProcessor as ip
+from toneStats import ToneStats
+
+parser = argparse.ArgumentParser(description='Benchmark the sonification pipeline')
+parser.add_argument('--sizes', help='Grid mode image sizes in megapixels', default='1,4')
+parser.add_argument('--pixel-sizes', help='Pixel mode image sizes in megapixels', default='1')
+parser.add_argument('--squares', help='Grid sizes to benchmark', default='20,100')
+parser.add_argument('--modes', help='Image kinds to benchmark', default='grey,rgb')
+parser.add_argument('--format', help='File format of the synthetic images', default='jpg', choices=['jpg', 'png'])
+parser.add_argument('--repeat', help='Runs of each configuration, the fastest is kept', default=1, type=int)
+parser.add_argument('--output', help='Json file the results are saved to', default=None)
+parser.add_argument('--baseline', help='Json results to compare against', default=None)
+parser.add_argument('--timeout', help='Seconds a configuration may run before it is stopped and reported as failed', default=600, type=float)
+parser.add_argument('--tolerance', help='Allowed slowdown against the baseline, as a fraction', default=0.25, type=float)
+parser.add_argument('--import-budget', help='Only check that importing imageProcessor takes at most this many ms, and loads no lazy modules', default=None, type=float)
+
+# Dependencies imageProcessor should only import on the code paths that use them
+LAZY_MODULES = ('PIL', 'imageio', 'midiutil', 'skimage', 'tifffile', 'matplotlib', 'cProfile',
+                'audio', 'wave', 'featureCache', 'manifest', 'hashlib', 'tempfile', 'pipeline',
+                'concurrent.futures')
+
+
+def makeImage(folder, megapixels, color, fileFormat='jpg', seed=0):
+    """
+    Writes a synthetic 4:3 image of about megapixels million pixels, a
+    smooth gradient with noise and flat areas, and returns its path
+    """
+    height = int(round((megapixels * 1e6 * 3 / 4) ** 0.5))
+    width = int(round(height * 4 / 3))
+    rng = np.random.default_rng(seed)
+
+    rows = np.linspace(0, 1, height)[:, np.newaxis]
+    columns = np.linspace(0, 1, width)[np.newaxis, :]
+    base = 40 + 150 * rows * columns + 40 * np.sin(columns * 12)
+    # A flat band, like sky or background
+    base[:height // 5] = 200
+    channels = 3 if color else 1
+    image = base[:, :, np.newaxis] + rng.normal(0, 8, (height, width, channels))
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    if not color:
+        image = image[:, :, 0]
+
+    path = os.path.join(folder, "synthetic-{}-{}mp.{}".format('rgb' if color else 'grey', megapixels, fileFormat))
+    Image.fromarray(image).save(path)
+    return path
+
+class StageTimer:
+    """
+    Records the wall time of named pipeline stages
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.stages[name] = time.perf_counter() - start
+        return result
+
+def benchmarkGrid(path, nSquares, greyScale):
+    """
+    Runs the grid pipeline stage by stage, returning the stage times
+    """
+    timer = StageTimer()
+    image, meanRed = timer.time('decode', ip.readImage, path)
+    means = timer.time('grid', ip.gridMeans, image, nSquares)
+    stats = timer.time('stats', ToneStats().update, means)
+    minTone, maxTone, toneInc = stats.toneRange()
+
+    scaleNote, scale, midiNotes, musicNotes = ip.getScale(meanRed)
+    scaleDict = dict(zip(midiNotes, musicNotes))
+    toneLibrary = ip.setToneLib(midiNotes, musicNotes, minTone, toneInc)
+    cellMeans = ip.dropEmptyCells(means)
+    tones = timer.time('quantize', ip.moveToneScale, cellMeans, toneLibrary, scaleDict, scale)
+    timer.time('csv', ip.saveMidiValues, "imageData", cellMeans, tones, scaleDict, scaleNote, 'bench')
+    timer.time('render', ip.saveGridImages, image, means, 'bench', greyScale, nSquares)
+    timer.time('midi', ip.makeMidi, 'bench', toneLibrary, tones)
+    return timer.stages
+
+def benchmarkPixels(path, greyScale, chunkRows=64):
+    """
+    Runs the streamed pixel pipeline, returning the stage times. Quantizing,
+    csv and midi writing are interleaved, so they are timed together.
+    """
+    timer = StageTimer()
+    image, meanRed = timer.time('decode', ip.readImage, path)
+    stats = timer.time('stats', ip.getPixelValues, image, {}, 'bench', chunkRows)
+    minTone, maxTone, toneInc = stats.toneRange()
+
+    scaleNote, scale, midiNotes, musicNotes = ip.getScale(meanRed)
+    scaleDict = dict(zip(midiNotes, musicNotes))
+    toneLibrary = ip.setToneLib(midiNotes, musicNotes, minTone, toneInc)
+    timer.time('stream', ip.sonifyPixels, "imageData", image, toneLibrary, scaleDict, scale, scaleNote,
+               'bench', chunkRows)
+    return timer.stages
+
+def _runConfig(config, results):
+    """
+    Runs one configuration in a fresh process, so peak memory is its own.
+    An error is sent back as its traceback.
+    """
+    try:
+        with tempfile.TemporaryDirectory(prefix='sonibench-') as folder:
+            # The pipeline writes its outputs relative to the working folder
+            os.chdir(folder)
+            try:
+                for subFolder in ("gridImages", "imageData", "midiFiles"):
+                    ip.makeFolder(subFolder)
+
+                path = makeImage(folder, config['megapixels'], config['color'], config['format'])
+                with Image.open(path) as image:
+                    pixels = image.size[0] * image.size[1]
+                greyScale = not config['color']
+
+                if config['pixel']:
+                    stages = benchmarkPixels(path, greyScale)
+                else:
+                    stages = benchmarkGrid(path, config['squares'], greyScale)
+            finally:
+                os.chdir(os.path.dirname(folder))
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+        return
+    results.put({'stages': stages, 'pixels': pixels, 'peakRssMB': metrics.peakRss()})
+
+def runConfig(config, timeout=None):
+    """
+    Runs a configuration in a child process and returns its measurements.
+    Raises RuntimeError if the configuration fails, its process dies, or it
+    runs for longer than timeout seconds.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_runConfig, args=(config, results))
+    process.start()
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive() and results.empty():
+                    raise RuntimeError("the benchmark process exited with code {}".format(process.exitcode))
+                if timeout and time.perf_counter() - start > timeout:
+                    raise RuntimeError("stopped after {:.0f} s".format(timeout))
+    finally:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+    if 'error' in result:
+        raise RuntimeError(result['error'].rstrip())
+    return result
+
+def configName(config):
+    """
+    Returns the name results are stored and compared under
+    """
+    kind = 'rgb' if config['color'] else 'grey'
+    if config['pixel']:
+        return "pixel-{}-{}mp".format(kind, config['megapixels'])
+    return "grid-{}-{}mp-n{}".format(kind, config['megapixels'], config['squares'])
+
+def getConfigs(args):
+    """
+    Returns the configurations selected by the command line
+    """
+    configs = []
+    for mode in args.modes.split(','):
+        color = mode == 'rgb'
+        for size in filter(None, args.sizes.split(',')):
+            for nSquares in args.squares.split(','):
+                configs.append({'megapixels': float(size), 'color': color, 'pixel': False,
+                                'squares': int(nSquares), 'format': args.format})
+        for size in filter(None, args.pixel_sizes.split(',')):
+            configs.append({'megapixels': float(size), 'color': color, 'pixel': True,
+                            'squares': None, 'format': args.format})
+    return configs
+
+def runBenchmarks(configs, repeat=1, timeout=None):
+    """
+    Runs each configuration repeat times, keeping the fastest time of each
+    stage and the largest peak memory. Configurations that fail are kept
+    with their error.
+    """
+    results = {}
+    for config in configs:
+        name = configName(config)
+        try:
+            runs = [runConfig(config, timeout) for _ in range(repeat)]
+        except RuntimeError as e:
+            results[name] = {'config': config, 'error': str(e)}
+            print("{:<28} failed: {}".format(name, e))
+            continue
+        stages = {}
+        for stage in runs[0]['stages']:
+            seconds = min(run['stages'][stage] for run in runs)
+            stages[stage] = {'seconds': seconds, 'pixelsPerSecond': runs[0]['pixels'] / seconds if seconds else None}
+        total = sum(stage['seconds'] for stage in stages.values())
+        results[name] = {'config': config, 'pixels': runs[0]['pixels'], 'stages': stages,
+                         'totalSeconds': total, 'peakRssMB': max(run['peakRssMB'] for run in runs)}
+        print("{:<28} {:>8.3f}s {:>8.1f} MB  ".format(name, total, results[name]['peakRssMB']) +
+              "  ".join("{} {:.3f}s".format(stage, stages[stage]['seconds']) for stage in stages))
+    return results
+
+def compareResults(results, baseline, tolerance=0.25):
+    """
+    Returns descriptions of stages slower than the baseline by more than
+    tolerance, and peak memory more than tolerance above it
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or 'error' in result or 'error' in baseline[name]:
+            continue
+        previous = baseline[name]
+        for stage, timing in result['stages'].items():
+            before = previous['stages'].get(stage, {}).get('seconds')
+            # Very short stages are too noisy to compare
+            if before and max(before, timing['seconds']) > 0.01 and timing['seconds'] > before * (1 + tolerance):
+                regressions.append("{} {}: {:.3f}s, was {:.3f}s".format(name, stage, timing['seconds'], before))
+        if result['peakRssMB'] > previous['peakRssMB'] * (1 + tolerance):
+            regressions.append("{} peak memory: {:.1f} MB, was {:.1f} MB".format(
+                name, result['peakRssMB'], previous['peakRssMB']))
+    return regressions
+
+def importTime(module='imageProcessor', repeat=5):
+    """
+    Imports module in fresh interpreters, returning the fastest import time
+    in seconds and the LAZY_MODULES the import loaded
+    """
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import {}\n"
+            "print(time.perf_counter() - start)\n"
+            "print(','.join(name for name in {!r} if name in sys.modules))").format(module, LAZY_MODULES)
+    folder = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=folder, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout.split('\n')
+        times.append(float(output[0]))
+    return min(times), [name for name in output[1].split(',') if name]
+
+def checkImportBudget(budget):
+    """
+    Returns descriptions of how importing imageProcessor breaks the budget,
+    in ms, or loads dependencies eagerly
+    """
+    seconds, loaded = importTime()
+    print("Importing imageProcessor takes {:.1f} ms, budget {:.1f} ms".format(seconds * 1000, budget))
+    problems = []
+    if seconds * 1000 > budget:
+        problems.append("import took {:.1f} ms, budget {:.1f} ms".format(seconds * 1000, budget))
+    if loaded:
+        problems.append("import loaded {}".format(", ".join(loaded)))
+    return problems
+
+def environment():
+    """
+    Returns details of the machine and libraries the benchmark ran on
+    """
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    if args.import_budget is not None:
+        problems = checkImportBudget(args.import_budget)
+        for problem in problems:
+            print("Import budget:", problem)
+        raise SystemExit(1 if problems else 0)
+
+    results = runBenchmarks(getConfigs(args), args.repeat, args.timeout)
+    failed = [name for name, result in results.items() if 'error' in result]
+
+    if args.output:
+        with open(args.output, 'w') as myFile:
+            json.dump({'environment': environment(), 'results': results}, myFile, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as myFile:
+            baseline = json.load(myFile)['results']
+        regressions = compareResults(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions against {}".format(args.baseline))
+
+    if failed:
+        print("{} of {} configurations failed: {}".format(len(failed), len(results), ", ".join(failed)))
+        raise SystemExit(1)
@@ -0,0 +1,125 @@
+"""
+On-disk cache of the luminance values worked out from each image.
+
+Entries are keyed by a hash of the image file contents and the parameters
+used to analyse it, so re-runs that only change the scale or midi settings
+can skip decoding and grid reduction. The cache is kept under a size limit
+by removing the least recently used entries.
+"""
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+from toneStats import ToneStats
+
+# Bump when the stored values change meaning, so old entries are not reused
+CACHE_VERSION = 2
+
+
+def fileHash(fileName, blockSize=1 << 20):
+    """
+    Returns the sha256 hex digest of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(fileName, 'rb') as myFile:
+        for block in iter(lambda: myFile.read(blockSize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    Stores grid means (or pixel luminance stats), meanRed and ToneStats per
+    image as uncompressed npz files in folder, using at most maxBytes.
+    """
+
+    def __init__(self, folder, maxBytes=512 * 1024 * 1024):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.evict()
+
+    def key(self, fileName, pixel=False, nSquares=20, greyScale=False, fastDecode=False, channels=False,
+            rawShape=None, rawDtype='uint8', frame=False):
+        """
+        Returns the cache key for an image file and analysis parameters.
+        Raw dumps are also keyed by the shape and dtype they are read with,
+        and frames, read without alpha, are kept apart from images.
+        """
+        params = "v{}-pixel{}-squares{}-grey{}".format(CACHE_VERSION, int(pixel), nSquares, int(greyScale))
+        if fastDecode:
+            params += "-fast"
+        if channels:
+            params += "-channels"
+        if frame:
+            params += "-frame"
+        if rawShape is not None and os.path.splitext(fileName)[1].lower() == '.raw':
+            params += "-raw{}-{}".format("x".join(str(size) for size in rawShape), rawDtype)
+        return hashlib.sha256("{}-{}".format(fileHash(fileName), params).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns (values, meanRed, stats) for a key, or None if not cached
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                values = data['values']
+                meanRed = data['meanRed'].item()
+                stats = ToneStats.fromDict({'count': data['count'].item(),
+                                            'minVal': data['minVal'].item(),
+                                            'maxVal': data['maxVal'].item(),
+                                            'histogram': data['histogram']})
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return values, meanRed, stats
+
+    def put(self, key, values, meanRed, stats):
+        """
+        Stores an image's values, meanRed and stats, then evicts old entries
+        """
+        # Written to a temporary file first, so readers never see a partial entry
+        handle, tempPath = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as myFile:
+                np.savez(myFile, values=np.asarray(values), meanRed=np.float64(meanRed),
+                         count=np.int64(stats.count), minVal=np.float64(stats.minVal),
+                         maxVal=np.float64(stats.maxVal), histogram=stats.histogram)
+            os.replace(tempPath, self._path(key))
+        except BaseException:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in maxBytes
+        """
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.npz'):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
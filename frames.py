@@ -0,0 +1,282 @@
+"""
+Sonifies frame sequences (animated GIFs, multi-page TIFFs and folders of
+numbered frames) into one continuous midi file.
+
+Each frame is a time slice of frameBeats beats. Every grid cell holds its
+tone until its quantized luminance changes, and midi events are only
+written when the set of sounding pitches changes, so long, slowly changing
+sequences make small files. The cell edges are worked out once for the
+whole sequence, and only one frame is held in memory at a time.
+
+rangeMode 'global' sets the tone range and scale from the whole sequence.
+The frame means are spilled to a temporary file, so memory stays bounded.
+'sofar' works in one pass, with the range from the frames so far and the
+scale from the first frame, as a live source would need.
+
+    python frames.py animation.gif --squares 20 --frame-beats 0.5
+"""
+import os
+import re
+import argparse
+import tempfile
+
+import numpy as np
+
+import metrics
+import imageProcessor as ip
+from midiWriter import MidiWriter
+from toneStats import ToneStats
+from featureCache import FeatureCache
+
+parser = argparse.ArgumentParser(description='Sonify a frame sequence into one midi file')
+parser.add_argument('source', help='Animated GIF, multi-page TIFF or folder of numbered frames')
+parser.add_argument('--name', help='Name of the output files, the source name by default', default=None)
+parser.add_argument('--squares', help='Number of grid squares per side', default=20, type=int)
+parser.add_argument('--frame-beats', help='Beats each frame lasts', default=0.5, type=float)
+parser.add_argument('--range', help='Tone range from the whole sequence, or the frames so far', default='global', choices=['global', 'sofar'])
+parser.add_argument('--clip', help='Percent of luminance values clipped from each end of the tone range', default=0, type=float)
+parser.add_argument('--cache', help='Folder used to cache the means of frame files between runs', default=None)
+parser.add_argument('--cache-size', help='Maximum size of the cache folder in MB', default=512, type=float)
+
+FRAME_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff')
+
+# No tone: the cell is empty, or outside the tone range
+SILENT = ip.OUT_OF_RANGE
+
+
+def _naturalKey(fileName):
+    # frame2 sorts before frame10
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', fileName)]
+
+def framePaths(folder):
+    """
+    Returns the image files in a folder, in frame number order
+    """
+    names = [name for name in os.listdir(folder) if os.path.splitext(name)[1].lower() in FRAME_EXTENSIONS]
+    return [os.path.join(folder, name) for name in sorted(names, key=_naturalKey)]
+
+def frameMode(frame):
+    """
+    Returns the mode a PIL frame is read in: palette frames as RGB, bilevel
+    frames as L, and without alpha, so transparency is not counted as
+    luminance
+    """
+    return {'P': 'RGB', 'PA': 'RGB', 'RGBA': 'RGB', 'LA': 'L', '1': 'L'}.get(frame.mode, frame.mode)
+
+def frameArray(frame, mode=None):
+    """
+    Returns a PIL frame as an array, converted to mode, or to its frameMode
+    """
+    mode = mode or frameMode(frame)
+    if frame.mode != mode:
+        frame = frame.convert(mode)
+    return np.array(frame)
+
+def readFrame(path, mode=None):
+    """
+    Reads a frame file as an array, converted to mode, as sequence frames are
+    """
+    from PIL import Image
+
+    with metrics.stage('readFrame', bytesRead=metrics.fileSize(path)) as stage:
+        with Image.open(path) as frame:
+            array = frameArray(frame, mode)
+        stage['count'] = array.size
+    return array
+
+def iterFrames(source):
+    """
+    Yields (path, frame) for each frame of a source. For folders of frames
+    the frame is a function reading the file, so cached frames need not be
+    decoded, otherwise path is None and the frame an array. Every frame is
+    read without alpha, in the first frame's mode.
+    """
+    from PIL import Image, ImageSequence
+
+    if os.path.isdir(source):
+        paths = framePaths(source)
+        if not paths:
+            return
+        # Only the header is read here, so cached frames are still not decoded
+        with Image.open(paths[0]) as first:
+            mode = frameMode(first)
+        for path in paths:
+            yield path, lambda path=path: readFrame(path, mode)
+        return
+
+    with Image.open(source) as image:
+        mode = None
+        for frame in ImageSequence.Iterator(image):
+            # Pillow reads GIF frames after the first as RGB or RGBA, so
+            # every frame is read in the first frame's mode
+            mode = mode or frameMode(frame)
+            yield None, frameArray(frame, mode)
+
+def iterFrameMeans(source, nSquares=20, cache=None):
+    """
+    Yields (mean red, grid means) for each frame of a source. All frames
+    must be the same size, with the same number of channels. Frame files
+    are looked up in the cache first.
+    """
+    edges = shape = None
+    for path, frame in iterFrames(source):
+        if path is not None:
+            if cache is not None:
+                cacheKey = cache.key(path, nSquares=nSquares, frame=True)
+                cached = cache.get(cacheKey)
+                if cached is not None:
+                    values, meanRed, stats = cached
+                    yield meanRed, values
+                    continue
+            frame = frame()
+
+        if edges is None:
+            shape = frame.shape
+            edges = (ip.cellEdges(shape[0], nSquares), ip.cellEdges(shape[1], nSquares))
+        elif frame.shape[:2] != shape[:2]:
+            raise ValueError("Frame is {}x{}, the first frame was {}x{}".format(
+                frame.shape[1], frame.shape[0], shape[1], shape[0]))
+        elif frame.shape[2:] != shape[2:]:
+            raise ValueError("Frame has {} channels, the first frame had {}".format(
+                frame.shape[2] if frame.ndim > 2 else 1, shape[2] if len(shape) > 2 else 1))
+
+        with metrics.stage('frameMeans', count=frame.shape[0] * frame.shape[1]):
+            means = ip.gridMeans(frame, nSquares, edges)
+            meanRed = frame[:, :, 0].mean() if frame.ndim > 2 else 0
+        if cache is not None and path is not None:
+            cache.put(cacheKey, means, meanRed, ToneStats().update(means))
+        yield meanRed, means
+
+
+class ToneChanges:
+    """
+    Tracks the tone of each cell and how many cells sound each pitch, so
+    only changes to the set of sounding pitches become midi events
+    """
+
+    def __init__(self, cells):
+        self.tones = np.full(cells, SILENT, dtype=np.int64)
+        self.sounding = np.zeros(128, dtype=np.int64)
+
+    def update(self, tones):
+        """
+        Sets the cells' tones, and returns the cells that changed and the
+        pitches that stop and start sounding
+        """
+        changed = np.flatnonzero(tones != self.tones)
+        before = self.sounding > 0
+        old = self.tones[changed]
+        new = tones[changed]
+        np.subtract.at(self.sounding, old[old != SILENT], 1)
+        np.add.at(self.sounding, new[new != SILENT], 1)
+        self.tones[changed] = new
+
+        after = self.sounding > 0
+        return changed, np.flatnonzero(before & ~after), np.flatnonzero(after & ~before)
+
+    def stop(self):
+        """
+        Silences every cell, returning the pitches that were sounding
+        """
+        pitches = np.flatnonzero(self.sounding)
+        self.tones[:] = SILENT
+        self.sounding[:] = 0
+        return pitches
+
+
+def writeChanges(myFile, frame, cells, values, tones, scaleDict):
+    """
+    Writes a csv row for each cell whose tone changed in a frame
+    """
+    rows = ["{},{},{},{},{}\n".format(frame, cell, value, tone, scaleDict.get(tone, ''))
+            for cell, value, tone in zip(cells.tolist(), values[cells].tolist(), tones[cells].tolist())]
+    myFile.write("".join(rows))
+
+def frameScale(meanRed, minTone, toneInc):
+    """
+    Returns the scale name, scale, scale dict and tone library for a mean
+    red value and tone range
+    """
+    scaleNote, scale, midiNotes, musicNotes = ip.getScale(meanRed)
+    scaleDict = dict(zip(midiNotes, musicNotes))
+    return scaleNote, scale, scaleDict, ip.setToneLib(midiNotes, musicNotes, minTone, toneInc)
+
+def sonifyFrames(source, name=None, nSquares=20, frameBeats=0.5, rangeMode='global', clip=0, cache=None,
+                 dataFolder="imageData", midiFolder="midiFiles"):
+    """
+    Sonifies a frame sequence into dataFolder/NAME.csv, listing each cell
+    tone change, and midiFolder/NAME.mid. Returns the number of frames,
+    cell changes and midi events.
+    """
+    name = name or ip.imageName(source.rstrip('/'))
+    cells = nSquares * nSquares
+    with tempfile.TemporaryFile() as spill:
+        if rangeMode == 'global':
+            # First pass: the range and scale need every frame
+            stats = ToneStats()
+            redTotal = 0.0
+            frames = 0
+            for meanRed, means in iterFrameMeans(source, nSquares, cache):
+                stats.update(means)
+                redTotal += meanRed
+                frames += 1
+                spill.write(np.asarray(means, dtype=np.float64).tobytes())
+            if not frames:
+                raise ValueError("No frames found in {}".format(source))
+            spill.flush()
+            allMeans = np.memmap(spill, dtype=np.float64, mode='r', shape=(frames, cells))
+            frameSource = ((None, allMeans[frame]) for frame in range(frames))
+            minTone, maxTone, toneInc = stats.toneRange(clip)
+            scaleNote, scale, scaleDict, toneLibrary = frameScale(redTotal / frames, minTone, toneInc)
+        else:
+            stats = ToneStats()
+            frameSource = iterFrameMeans(source, nSquares, cache)
+            scaleRed = None
+
+        changes = ToneChanges(cells)
+        counts = {'frames': 0, 'changes': 0, 'events': 0}
+        with open(os.path.join(dataFolder, name + '.csv'), 'w') as myFile, \
+                open(os.path.join(midiFolder, name + '.mid'), 'wb') as midiFile:
+            myFile.write("Frame,Cell,Luminance,RescaledTone,MusicNote\n")
+            writer = MidiWriter(midiFile, tempo=60)
+            writer.startTrack(name)
+
+            for frame, (meanRed, means) in enumerate(frameSource):
+                if rangeMode == 'sofar':
+                    stats.update(means)
+                    minTone, maxTone, toneInc = stats.toneRange(clip)
+                    if scaleRed is None:
+                        # The scale stays that of the first frame
+                        scaleRed = meanRed
+                    scaleNote, scale, scaleDict, toneLibrary = frameScale(scaleRed, minTone, toneInc)
+
+                luminance = means if not clip else np.clip(means, minTone, maxTone)
+                tones = ip.quantizeTones(luminance, toneLibrary, scaleDict, scale).astype(np.int64)
+                changed, stopped, started = changes.update(tones)
+                writeChanges(myFile, frame, changed, np.asarray(means), tones, scaleDict)
+
+                time = frame * frameBeats
+                pitches = np.concatenate([stopped, started])
+                writer.addEvents(np.full(len(pitches), time), pitches, np.arange(len(pitches)) >= len(stopped))
+                counts['frames'] += 1
+                counts['changes'] += len(changed)
+                counts['events'] += len(pitches)
+
+            stopped = changes.stop()
+            writer.addEvents(np.full(len(stopped), counts['frames'] * frameBeats), stopped, False)
+            counts['events'] += len(stopped)
+            writer.close()
+    return counts
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    ip.makeFolder("imageData")
+    ip.makeFolder("midiFiles")
+    cache = None
+    if args.cache:
+        cache = FeatureCache(args.cache, maxBytes=int(args.cache_size * 1024 * 1024))
+
+    counts = sonifyFrames(args.source, args.name, args.squares, args.frame_beats, args.range, args.clip, cache)
+    print("{frames} frames, {changes} cell tone changes, {events} midi events".format(**counts))
@@ -1,27 +1,133 @@
 import os
-import copy
+import json
+import functools
+import threading
+import collections
 import argparse
-import imageio
 import numpy as np
-from PIL import ImageOps, Image
-from random import shuffle
 
-from midiutil.MidiFile import MIDIFile
+from midiWriter import MidiWriter
+from noteCompactor import NoteCompactor, DECIMATE_POLICIES, decimateFactor
+import metrics
+from toneStats import ToneStats
+from tiledImage import openImageArray, parseShape, stripRows, iterStrips
 from scales import scales, BASE_NOTES, BASE_MIDI_NOTE
 
-hasSkimage=False
-try:
-    import skimage
-    from skimage.viewer import ImageViewer
-    hasSkimage=True
-except ImportError:
-    pass
+# PIL, imageio, midiutil and skimage, and the modules for audio, caching,
+# watching and pipelining, are imported where they are used, so starting
+# the script and importing this module stay fast
 
 
-# Set command line interface
-parser = argparse.ArgumentParser()
-parser.add_argument('--pixel', help='Use to write midi from pixels, not grid', default=False, action='store_true')
-tones = {}
+def wavSeconds(value):
+    """
+    Parses a --wav note length in seconds, keeping 'fit' as it is
+    """
+    return value if value == 'fit' else float(value)
+
+def getParser():
+    """
+    Returns the command line interface
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pixel', help='Use to write midi from pixels, not grid', default=False, action='store_true')
+    parser.add_argument('--squares', help='Number of grid squares per side', default=20, type=int)
+    parser.add_argument('--chunk', help='Image rows streamed at a time in pixel mode', default=64, type=int)
+    parser.add_argument('--midiutil', help='Write grid midi files with midiutil, as a reference', default=False, action='store_true')
+    parser.add_argument('--jobs', help='Number of processes used to sonify the image list', default=1, type=int)
+    parser.add_argument('--pipeline', help='Decode the next images and write outputs on threads while each image is analysed', default=False, action='store_true')
+    parser.add_argument('--prefetch', help='Images decoded ahead in pipeline mode', default=2, type=int)
+    parser.add_argument('--writers', help='Threads writing grid images, csv and midi files in pipeline mode', default=2, type=int)
+    parser.add_argument('--max-inflight-mb', help='Most MB of decoded images held at once in pipeline mode', default=1024, type=float)
+    parser.add_argument('--range', help='Tone range from the images so far, or the whole batch', default='sofar', choices=['sofar', 'global'])
+    parser.add_argument('--clip', help='Percent of luminance values clipped from each end of the tone range', default=0, type=float)
+    parser.add_argument('--cache', help='Folder used to cache image luminance values between runs', default=None)
+    parser.add_argument('--cache-size', help='Maximum size of the cache folder in MB', default=512, type=float)
+    parser.add_argument('--fast-decode', help='Decode grid images at reduced resolution', default=False, action='store_true')
+    parser.add_argument('--fast-tolerance', help='Check fast decode grid means against full resolution, falling back when they differ by more than this', default=None, type=float)
+    parser.add_argument('--tiled', help='Memory map images where possible and read them in strips', default=False, action='store_true')
+    parser.add_argument('--raw-shape', help='Shape of .raw uint8 images as rows,columns[,channels]', default=None)
+    parser.add_argument('--render', help='Draw grid images at full size, as small previews, or not at all', default='full', choices=['full', 'preview', 'none'])
+    parser.add_argument('--preview-size', help='Longest side of preview grid images', default=512, type=int)
+    parser.add_argument('--channels', help='Also write a midi file with a track for each of red, green, blue and luminance', default=False, action='store_true')
+    parser.add_argument('--sidecar', help='Also save the csv columns as a binary .npy file', default=False, action='store_true')
+    parser.add_argument('--wav', help='Also render the tones to a WAV file in audioFiles, optionally with this many seconds per note (default 0.5, as in the midi file, or shorter if needed to fit a WAV file)', default=None, nargs='?', const='fit', type=wavSeconds)
+    parser.add_argument('--merge', help='Merge runs of the same tone into longer midi notes', default=False, action='store_true')
+    parser.add_argument('--decimate', help='Reduce each block of this many tones to one midi note', default=1, type=int)
+    parser.add_argument('--decimate-policy', help='Tone kept from each decimated block', default='first', choices=sorted(DECIMATE_POLICIES))
+    parser.add_argument('--max-notes', help='Decimate enough to write at most this many midi notes per image', default=None, type=int)
+    parser.add_argument('--max-note-beats', help='Longest merged note, in beats', default=None, type=float)
+    parser.add_argument('--watch', help='Sonify new and changed images in this folder as they arrive, instead of images.txt', default=None)
+    parser.add_argument('--watch-grey', help='Draw the grid images of watched images in grey, as a 1 in images.txt does', default=False, action='store_true')
+    parser.add_argument('--poll', help='Seconds between scans of the watched folder', default=2, type=float)
+    parser.add_argument('--settle', help='Seconds an image must be unmodified before it is sonified', default=1, type=float)
+    parser.add_argument('--once', help='Scan the watched folder once, then exit', default=False, action='store_true')
+    parser.add_argument('--manifest', help='Manifest of the images sonified from the watched folder', default='imageData/manifest.json')
+    parser.add_argument('--metrics', help='File per-stage metrics are appended to as json lines', default=None)
+    parser.add_argument('--profile', help='Profile the run with cProfile and tracemalloc, saving the stats to this file', default=None)
+    return parser
+
+def parseArgs(argv=None):
+    """
+    Parses command line arguments, from sys.argv if argv is not given
+    """
+    return getParser().parse_args(argv)
+
+def compactOptions(args):
+    """
+    Returns the midi note compaction options from parsed arguments, or None
+    when notes are written one per tone
+    """
+    if not args.merge and args.decimate <= 1 and not args.max_notes:
+        return None
+    return {'merge': args.merge, 'decimate': args.decimate, 'policy': args.decimate_policy,
+            'maxNotes': args.max_notes, 'maxNoteBeats': args.max_note_beats}
+
+def analyseOptions(args, cache=None, rawShape=None):
+    """
+    Returns the analyseImage keyword arguments from parsed arguments
+    """
+    return {'pixel': args.pixel, 'nSquares': args.squares, 'chunkRows': args.chunk, 'cache': cache,
+            'fastDecode': args.fast_decode, 'fastTolerance': args.fast_tolerance, 'tiled': args.tiled,
+            'rawShape': rawShape, 'render': args.render, 'previewSize': args.preview_size,
+            'channels': args.channels}
+
+def outputOptions(args, rawShape=None):
+    """
+    Returns the writeOutputs keyword arguments from parsed arguments
+    """
+    return {'pixel': args.pixel, 'chunkRows': args.chunk, 'reference': args.midiutil, 'clip': bool(args.clip),
+            'tiled': args.tiled, 'rawShape': rawShape, 'sidecar': args.sidecar, 'wav': args.wav,
+            'compact': compactOptions(args)}
+
+@functools.lru_cache(maxsize=1)
+def loadSkimage():
+    """
+    Returns skimage with its drawing module loaded, or None if it is not
+    installed or cannot draw disks. Only needed to mask grid images.
+    """
+    try:
+        import skimage.draw
+    except ImportError:
+        return None
+    # disk replaced circle in skimage 0.19
+    if not hasattr(skimage.draw, 'disk') and not hasattr(skimage.draw, 'circle'):
+        return None
+    return skimage
+
+# Circle masks kept for reuse, least recently used first, up to
+# MASK_CACHE_BYTES in all
+MASK_CACHE_BYTES = 64 * 1024 * 1024
+_maskCache = collections.OrderedDict()
+_maskLock = threading.Lock()
+
+# Marks luminance values that fall outside the tone library
+OUT_OF_RANGE = -1
+
+# Colour channels given their own tracks by --channels
+CHANNEL_NAMES = ('Red', 'Green', 'Blue')
+
+# Files picked up from a watched folder
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.npy', '.raw')
 
 def makeFolder(folderName):
     """
@@ -32,13 +138,18 @@ def makeFolder(folderName):
     return folderName
 
 def saveImage(folder, fileName, image):
+    import imageio
+    from PIL import Image
+
     imagePath = os.path.join(folder, os.path.basename(fileName + '.png'))
-    try:
-        imageio.imwrite(imagePath, image)
-    except Exception as e:
-        print(e)
-        im = Image.fromarray(image)
-        im.save(imagePath)
+    with metrics.stage('saveImage', count=image.size) as stage:
+        try:
+            imageio.imwrite(imagePath, image)
+        except Exception as e:
+            print(e)
+            im = Image.fromarray(image)
+            im.save(imagePath)
+        stage['bytesWritten'] = metrics.fileSize(imagePath)
 
 def getImagePaths(fileName):
     """
@@ -48,27 +159,97 @@ def getImagePaths(fileName):
         files = [f.strip() for f in myFile.readlines()]
         return files
 
-def readImage(fileName):
+def readImage(fileName, withMeanRed=True):
     """
     Reads image using imageio, and returns greyscale image
+    The mean red value is None without withMeanRed, for callers that work
+    it out in their own pass over the image.
     """
-    temp = Image.open(fileName)
-    image = np.array(temp)
-    meanRed = 0
+    from PIL import Image
+
+    with metrics.stage('readImage', bytesRead=metrics.fileSize(fileName)) as stage:
+        temp = Image.open(fileName)
+        image = np.array(temp)
+        meanRed = 0 if withMeanRed else None
 
-    # Get mean red value, if image is color
-    if len(image.shape) > 2:
-        meanRed = image[:, :, 0].mean()
+        # Get mean red value, if image is color
+        if withMeanRed and len(image.shape) > 2:
+            meanRed = image[:, :, 0].mean()
+        stage['count'] = image.size
        
     return image, meanRed
 
+def imageBytes(fileName):
+    """
+    Returns the bytes readImage will decode an image to, from its header
+    """
+    from PIL import Image
+
+    with Image.open(fileName) as image:
+        itemSize = {'I;16': 2, 'I;16B': 2, 'I;16L': 2, 'I': 4, 'F': 4}.get(image.mode, 1)
+        return image.width * image.height * len(image.getbands()) * itemSize
 
+def readImageReduced(fileName, nSquares=20, minCellPixels=32):
+    """
+    Reads image at the smallest scale that keeps at least minCellPixels
+    pixels along each side of a grid cell. JPEGs are decoded at reduced
+    scale with draft, and any remaining reduction uses block averaging,
+    where the image mode allows it.
+    Returns the image, meanRed and the full resolution shape.
+    """
+    from PIL import Image
+
+    with metrics.stage('readImageReduced', bytesRead=metrics.fileSize(fileName)) as stage:
+        temp = Image.open(fileName)
+        width, height = temp.size
+        factor = max(1, min(width, height) // (nSquares * minCellPixels))
+
+        if factor > 1:
+            if temp.format == 'JPEG':
+                # draft picks the largest DCT scale that keeps at least this size
+                temp.draft(temp.mode, (width // factor, height // factor))
+            remaining = temp.size[0] // (width // factor)
+            if remaining > 1:
+                try:
+                    temp = temp.reduce(remaining)
+                except ValueError:
+                    # Palette, bilevel and 16 bit images cannot be block averaged, so are read in full
+                    pass
+
+        image = np.array(temp)
+        meanRed = 0
+
+        # Get mean red value, if image is color
+        if len(image.shape) > 2:
+            meanRed = image[:, :, 0].mean()
+        stage['count'] = image.size
+
+    return image, meanRed, (height, width)
+
+def reducedErrorBound(fullShape, reducedShape, nSquares=20):
+    """
+    Returns a worst case bound, in luminance levels, on how far reduced
+    resolution cell means can be from the full resolution ones because of
+    cell edges moving by up to half a reduced pixel. Decoder rounding and
+    filtering are not included; checkReducedDecode measures the actual error.
+    """
+    fraction = 0
+    for length, reducedLength in zip(fullShape[:2], reducedShape[:2]):
+        if reducedLength == length:
+            # Edges map onto themselves at full resolution
+            continue
+        scale = length / reducedLength
+        cellSize = int(round(length / nSquares, 0))
+        if cellSize == 0:
+            return 255.0
+        # Both edges of a cell can move by half a reduced pixel
+        fraction += min(1, scale / cellSize)
+    return 255.0 * min(1, fraction)
 
-def createGrid(image):
+def createGrid(image, nSquares=20):
     """
     Takes image and returns nSquares ^ 2 grid coordinates
     """
-    nSquares = 20
     gridSizeX = int(round(image.shape[0] / nSquares, 0))
     gridSizeY = int(round(image.shape[1] / nSquares, 0))
     grid = []
@@ -92,76 +273,363 @@ def createGrid(image):
         y2 = gridSizeY
     return grid
 
-def getPixelValues(image, tones, name):
+def cellEdges(length, nSquares=20):
+    """
+    Returns the nSquares + 1 cell boundaries along one image axis. The
+    rounded cell size of createGrid is kept while the grid it gives misses
+    or overshoots the axis by less than half a cell, the last cell being
+    clipped to the image. Otherwise the boundaries are spread evenly over
+    the whole axis, so no cell is empty unless there are more squares than
+    pixels.
+    """
+    gridSize = int(round(length / nSquares, 0))
+    if abs(nSquares * gridSize - length) < gridSize / 2:
+        return np.minimum(np.arange(nSquares + 1) * gridSize, length)
+    return np.round(np.linspace(0, length, nSquares + 1)).astype(np.intp)
+
+def _reduceCells(array, edges, axis):
+    """
+    Sums array between consecutive edges along axis in one reduceat call.
+    Empty cells are returned as zero sums.
+    """
+    length = array.shape[axis]
+    shape = list(array.shape)
+    shape[axis] = len(edges) - 1
+    sums = np.zeros(shape, dtype=np.float64)
+
+    # reduceat needs strictly increasing start indices inside the array
+    nonEmpty = np.flatnonzero(edges[:-1] < edges[1:])
+    if not len(nonEmpty):
+        return sums
+    starts = edges[nonEmpty]
+    # Add the trailing remainder as a segment of its own so it is dropped
+    if edges[-1] < length:
+        starts = np.append(starts, edges[-1])
+    reduced = np.add.reduceat(array, starts, axis=axis, dtype=np.float64)
+    reduced = np.take(reduced, np.arange(len(nonEmpty)), axis=axis)
+
+    index = [slice(None)] * array.ndim
+    index[axis] = nonEmpty
+    sums[tuple(index)] = reduced
+    return sums
+
+def reducedCellEdges(length, reducedLength, nSquares=20):
+    """
+    Maps the full resolution cell boundaries of an axis onto the same axis
+    reduced to reducedLength pixels
+    """
+    return np.round(cellEdges(length, nSquares) * reducedLength / length).astype(np.intp)
+
+def cellSums(image, nSquares=20, edges=None):
+    """
+    Returns per-cell, per-channel float64 sums with shape
+    (nSquares, nSquares, channels) and the pixel count of each cell.
+    Cells follow the createGrid layout, unless (row, column) cell edges
+    are given; pixels outside the grid are ignored.
+    """
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    if edges is None:
+        edges = (cellEdges(image.shape[0], nSquares), cellEdges(image.shape[1], nSquares))
+    edgesX, edgesY = edges
+
+    # Reduce along columns first, then collapse the (much smaller) row axis
+    sums = _reduceCells(image, edgesY, axis=1)
+    sums = _reduceCells(sums, edgesX, axis=0)
+    counts = np.outer(np.diff(edgesX), np.diff(edgesY))
+    return sums, counts
+
+def gridMeans(image, nSquares=20, edges=None):
+    """
+    Returns the mean luminance of each grid cell as a float64 array of length
+    nSquares ^ 2, in the same order as createGrid. Empty cells are NaN.
+    """
+    sums, counts = cellSums(image, nSquares, edges)
+    return _cellMeans(sums, counts)
+
+def channelMeans(image, nSquares=20, edges=None):
+    """
+    Returns the mean of each channel and of luminance in every grid cell, as
+    a (nSquares ^ 2, channels + 1) array with luminance last, and the mean
+    red value of the whole image, all from one pass over the image. The
+    luminance column equals gridMeans, and greyscale images have one
+    channel and a mean red value of 0.
+    """
+    if edges is None:
+        edges = (cellEdges(image.shape[0], nSquares), cellEdges(image.shape[1], nSquares))
+    edgesX, edgesY = edges
+    sums, counts = cellSums(image, nSquares, edges)
+
+    meanRed = 0
+    if image.ndim > 2:
+        # Pixels outside the grid count towards the mean red value too
+        redSum = (sums[:, :, 0].sum() + image[edgesX[-1]:, :, 0].sum(dtype=np.float64)
+                  + image[:edgesX[-1], edgesY[-1]:, 0].sum(dtype=np.float64))
+        meanRed = redSum / (image.shape[0] * image.shape[1])
+    return _channelMeans(sums, counts), meanRed
+
+def _cellMeans(sums, counts):
+    """
+    Averages per-cell, per-channel sums into flattened cell means
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums.sum(axis=2) / (counts * sums.shape[2])
+    return means.ravel()
+
+def _channelMeans(sums, counts):
+    """
+    Averages per-cell, per-channel sums into a column of cell means per
+    channel, followed by the luminance column
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts[:, :, np.newaxis]
+    return np.column_stack([means.reshape(-1, sums.shape[2]), _cellMeans(sums, counts)])
+
+def tiledGridMeans(array, nSquares=20, tileBytes=64 * 1024 * 1024, channels=False):
+    """
+    Returns the grid means and mean red value of an image array, reading
+    it one strip of rows at a time so a memory mapped image is never loaded
+    whole. Sums of integer pixels are exact, so the values match gridMeans
+    and readImage. channels returns the means as channelMeans does.
+    """
+    bands = array.shape[2] if array.ndim > 2 else 1
+    edgesX = cellEdges(array.shape[0], nSquares)
+    edgesY = cellEdges(array.shape[1], nSquares)
+    sums = np.zeros((nSquares, nSquares, bands), dtype=np.float64)
+    redSum = 0.0
+
+    with metrics.stage('tiledGridMeans', bytesRead=array.nbytes, count=array.size):
+        for row, strip in iterStrips(array, stripRows(array, tileBytes)):
+            if array.ndim > 2:
+                redSum += strip[:, :, 0].sum(dtype=np.float64)
+            else:
+                strip = strip[:, :, np.newaxis]
+
+            # Cell row edges relative to this strip
+            localEdges = np.clip(edgesX - row, 0, strip.shape[0])
+            if localEdges[0] < localEdges[-1]:
+                sums += _reduceCells(_reduceCells(strip, edgesY, axis=1), localEdges, axis=0)
+
+    meanRed = 0
+    if array.ndim > 2:
+        meanRed = redSum / (array.shape[0] * array.shape[1])
+    counts = np.outer(np.diff(edgesX), np.diff(edgesY))
+    if channels:
+        return _channelMeans(sums, counts), meanRed
+    return _cellMeans(sums, counts), meanRed
+
+def tiledMeanRed(array, tileBytes=64 * 1024 * 1024):
+    """
+    Returns the mean red value of an image array, one strip at a time
+    """
+    if array.ndim < 3:
+        return 0
+    redSum = 0.0
+    for row, strip in iterStrips(array, stripRows(array, tileBytes)):
+        redSum += strip[:, :, 0].sum(dtype=np.float64)
+    return redSum / (array.shape[0] * array.shape[1])
+
+def pixelLuminance(rows):
+    """
+    Returns the flattened luminance of a block of image rows. Greyscale rows
+    are returned as they are, color pixels are averaged across channels.
+    """
+    if rows.ndim > 2:
+        return rows.mean(axis=2).ravel()
+    return rows.ravel()
+
+def iterPixelChunks(image, chunkRows=64):
     """
-    Appends the luminance values for each pixel to the tones lib
+    Yields the pixel luminance values chunkRows image rows at a time
     """
-    for row in image:
-        for val in row:
-            tones[name].append(val)
+    for row in range(0, image.shape[0], chunkRows):
+        yield pixelLuminance(np.asarray(image[row:row + chunkRows]))
+
+def getPixelValues(image, tones, name, chunkRows=64):
+    """
+    Stores the luminance range of the image pixels in the tones lib, and
+    returns their ToneStats. Pixel values are streamed from the image later,
+    so only the min and max are kept.
+    """
+    stats = ToneStats()
+    with metrics.stage('getPixelValues', count=image.shape[0] * image.shape[1]):
+        for chunk in iterPixelChunks(image, chunkRows):
+            stats.update(chunk)
+    tones[name] = np.array([stats.minVal, stats.maxVal])
+    return stats
     
-def getGridValues(image, tones, name, greyScale=False):
+def previewStep(shape, previewSize=None):
     """
-    Appends the luminance values for each grid to the tones lib
-    Also creates an image from mean grid pieces to demonstrate the effect
+    Returns the step between the pixels taken for a preview whose longest
+    side fits previewSize, or 1 for a full size render
     """
-    testImage = image  # test image visualises the grid
-    redImage = copy.copy(image)  # needs copy of image to change individually
-    # Get grid
-    grid = createGrid(image)
+    if not previewSize:
+        return 1
+    return max(1, -(-max(shape[:2]) // previewSize))
 
-    # Make mask size of image
-    mask = np.ones(shape=image.shape[0:2], dtype="bool") 
-    mod =  np.random.choice(np.arange(-200, 200, 20), size=1)[0]
+def drawDisk(x, y, radius, shape):
+    """
+    Returns the rows and columns of the pixels inside a circle, with
+    skimage.draw.disk, or circle before skimage 0.19
+    """
+    draw = loadSkimage().draw
+    if hasattr(draw, 'disk'):
+        return draw.disk((x, y), radius, shape=shape)
+    return draw.circle(x, y, radius=radius, shape=shape)
 
-    # Get tones 
-    for piece in grid:
-        newImage = image[piece[0]:piece[1], piece[2]:piece[3]]
-        tones[name].append(newImage.mean())
-        testImage[piece[0]:piece[1], piece[2]:piece[3]] = newImage.mean()
-        
-        # Mask drawn using code adapted from 
-        # https://datacarpentry.org/image-processing/04-drawing/
+def circleMask(shape, nSquares=20, mod=0, edges=None, step=1):
+    """
+    Returns a read only mask of the pixels outside the circle drawn in each
+    grid cell, for an image shape, grid and row offset. With step, the mask
+    is drawn at the resolution of a preview taking every step-th pixel.
+    Masks are cached up to MASK_CACHE_BYTES, so images with the same
+    geometry reuse them.
+    """
+    if edges is None:
+        edges = (cellEdges(shape[0], nSquares), cellEdges(shape[1], nSquares))
+    key = (tuple(shape), tuple(edges[0].tolist()), tuple(edges[1].tolist()), mod, step)
+    with _maskLock:
+        if key in _maskCache:
+            _maskCache.move_to_end(key)
+            return _maskCache[key]
 
-        offsetY = piece[3] - piece[2]   # Y offset
-        offsetX = piece[1] - piece[0]   # X offset
-        offset = min(offsetX, offsetY)  # take the smallest size for radius
-        radius = offset / 2             # Radius from grid size
-        
-        mod = mod * -1  # modify start point for offsetting rows
-        x = piece[0] + offset / 2 - mod 
-        y = piece[2] + offset / 2 
+    # Make mask size of the rendered image
+    maskShape = (-(-shape[0] // step), -(-shape[1] // step))
+    mask = np.ones(shape=maskShape, dtype="bool")
+    edgesX, edgesY = edges
+    for x1, x2 in zip(edgesX[:-1].tolist(), edgesX[1:].tolist()):
+        for y1, y2 in zip(edgesY[:-1].tolist(), edgesY[1:].tolist()):
+            # Mask drawn using code adapted from
+            # https://datacarpentry.org/image-processing/04-drawing/
+            offset = min(x2 - x1, y2 - y1)  # take the smallest size for radius
+            radius = offset / 2             # Radius from grid size
+
+            mod = mod * -1  # modify start point for offsetting rows
+            x = x1 + offset / 2 - mod
+            y = y1 + offset / 2
 
-        if hasSkimage:
-            rr, cc = skimage.draw.circle(x, y, radius=radius, shape=image.shape[0:2])
+            # Preview pixels sit every step full resolution pixels
+            rr, cc = drawDisk(x / step, y / step, radius / step, maskShape)
             mask[rr, cc] = False
+    mask.flags.writeable = False
 
-        # Create grid image in red only
-        if not greyScale:
-            redImage[piece[0]:piece[1], piece[2]:piece[3], :] = newImage.mean()
-            redImage[piece[0]:piece[1], piece[2]:piece[3], 1] = 0
-            redImage[piece[0]:piece[1], piece[2]:piece[3], 2] = 0
+    with _maskLock:
+        if mask.nbytes <= MASK_CACHE_BYTES:
+            _maskCache[key] = mask
+            while sum(cached.nbytes for cached in _maskCache.values()) > MASK_CACHE_BYTES:
+                _maskCache.popitem(last=False)
+    return mask
 
-    if hasSkimage:
+def renderGrid(image, means, nSquares=20, greyScale=False, edges=None, mask=None, previewSize=None):
+    """
+    Returns an image of the grid cells filled with their mean values, and
+    the same in red only (None for greyscale images). The input image is not
+    changed. Pixels in mask, drawn at the rendered or full resolution, are
+    blacked out. previewSize limits the longest side of the rendered images
+    by taking every nth pixel.
+    """
+    if edges is None:
+        edges = (cellEdges(image.shape[0], nSquares), cellEdges(image.shape[1], nSquares))
+    edgesX, edgesY = edges
+
+    step = previewStep(image.shape, previewSize)
+    if step > 1:
+        image = image[::step, ::step]
+        # First preview pixel at or after each full resolution edge
+        edgesX = -(-edgesX // step)
+        edgesY = -(-edgesY // step)
+        if mask is not None and mask.shape != image.shape[:2]:
+            # A full resolution mask
+            mask = mask[::step, ::step]
+
+    # Mean of each cell repeated over the cell's pixels, in one pass
+    cells = np.repeat(np.repeat(means.reshape(nSquares, nSquares), np.diff(edgesX), axis=0),
+                      np.diff(edgesY), axis=1)
+    if image.ndim > 2:
+        cells = cells[:, :, np.newaxis]
+
+    # test image visualises the grid, pixels outside the grid are left as they are
+    testImage = np.array(image)
+    testImage[:edgesX[-1], :edgesY[-1]] = cells
+
+    # Create grid image in red only
+    redImage = None
+    if not greyScale and image.ndim > 2:
+        # Outside the grid the test image is the original image, as wanted
+        redImage = testImage.copy()
+        redImage[:edgesX[-1], :edgesY[-1], 1:] = 0
+
+    if mask is not None:
         testImage[mask] = 0
-        redImage[mask] = 0
+        if redImage is not None:
+            redImage[mask] = 0
+    return testImage, redImage
+
+def getGridValues(image, tones, name, greyScale=False, nSquares=20, edges=None, render='full', previewSize=512,
+                  channels=False, submit=None):
+    """
+    Stores the mean luminance values for each grid cell in the tones lib
+    Also creates an image from mean grid pieces to demonstrate the effect,
+    unless render is 'none'. 'preview' renders it at most previewSize
+    pixels across.
+    Returns the stored values and the mean red value of the image, worked
+    out in the same pass. With channels, the values are the channelMeans
+    columns rather than luminance alone. submit, if given, is called as
+    submit(function, *args) to render the grid images on another thread.
+    """
+    # Get tones
+    with metrics.stage('getGridValues', count=image.shape[0] * image.shape[1]):
+        channelValues, meanRed = channelMeans(image, nSquares, edges)
+        means = channelValues[:, -1]
+        tones[name] = channelValues if channels else means
+
+        if render != 'none':
+            (submit or _call)(saveGridImages, image, means, name, greyScale, nSquares, edges,
+                              previewSize if render == 'preview' else None)
+    return tones[name], meanRed
+
+def _call(function, *args):
+    return function(*args)
+
+def gridMask(shape, nSquares=20, edges=None, previewSize=None):
+    """
+    Returns a circle mask with a random row offset for an image shape, or
+    None when skimage is not installed. With previewSize, the mask is drawn
+    at the preview's resolution.
+    """
+    if loadSkimage() is None:
+        return None
+    mod =  np.random.choice(np.arange(-200, 200, 20), size=1)[0]
+    return circleMask(shape, nSquares, int(mod), edges, previewStep(shape, previewSize))
+
+def saveGridImages(image, means, name, greyScale=False, nSquares=20, edges=None, previewSize=None):
+    """
+    Renders the grid images and saves them to the gridImages folder
+    """
+    mask = gridMask(image.shape[0:2], nSquares, edges, previewSize)
+    testImage, redImage = renderGrid(image, means, nSquares, greyScale, edges, mask, previewSize)
 
     # Save grid as image
     saveImage("gridImages", name, testImage)
-    if not greyScale:
+    if redImage is not None:
         saveImage("gridImages", 'red{}'.format(name), redImage)
 
-def toneRange(tones):
+def toneRange(tones, clip=0):
     """
     Return min, max and tone increment luminance values 
     """
-    allTones = []
-    [allTones.extend(tones[each]) for each in tones]
-    minTone = int(min(allTones))
-    maxTone = int(max(allTones))
+    stats = ToneStats()
+    for each in tones:
+        stats.update(tones[each])
+    return reportToneRange(stats, clip)
 
-    # The tone increment
-    toneIncrement = (maxTone - minTone) / 12
+def reportToneRange(stats, clip=0):
+    """
+    Return and print min, max and tone increment luminance values from
+    ToneStats, optionally clipping clip percent from each end
+    """
+    with metrics.stage('toneRange', count=stats.count):
+        minTone, maxTone, toneIncrement = stats.toneRange(clip)
     
     print("Your lowest luminance is {}".format(minTone))
     print("Your highest luminance is {}".format(maxTone))
@@ -209,85 +677,898 @@ def calculateScale(offset):
     musicNote.extend(BASE_NOTES[:offset])
     return midiNote, musicNote
 
-def moveToneScale(values, toneLibrary, scaleDict, scale):
-    
-    #scaleDict contains the midivalues for the scale, and the music notes in order
-    # Midi values and notes are key value pairs
-    rescaledTones = []
+def toneBounds(toneLibrary):
+    """
+    Returns the midi tones of the tone library, the lowest luminance and the
+    upper luminance bound of each tone, in library order
+    """
+    bounds = [toneLibrary[tone]['tone'] for tone in toneLibrary]
+    midiTones = np.array(list(toneLibrary), dtype=np.int16)
+    upper = np.array([bound[1] for bound in bounds], dtype=np.float64)
+    lower = bounds[0][0]
+    return midiTones, lower, upper
 
+def rescaleTable(midiTones, scaleDict, scale):
+    """
+    Returns the rescaled midi tone for each library tone as an int16 array
+    """
     # Max allowable tone is used to check whether the tone exceeds the scale
     # If the tone exceeds the scale, it is scaled to a scale base note 
     # 12 tones is offset by one, because offset is inclusive of note 1
     maxAllowableTone = BASE_MIDI_NOTE + scale['offset'] + (12 - 1)
 
-    # Loop through the mean grid values
-    # Get the tone from the library
     # If the tone is in the scale, do nothing
     # Else, add a semitone to make the tone fit the scale
-
-    for meanVal in values:
-        tone = getTone(toneLibrary, meanVal)  
+    table = []
+    for tone in midiTones.tolist():
         if scaleDict[tone] in scale['scale']:
-            rescaledTones.append(tone)
+            table.append(tone)
         elif (tone + 1) > maxAllowableTone:
-            rescaledTones.append(tone - (12 - 1))
+            table.append(tone - (12 - 1))
         else:
-            rescaledTones.append(tone + 1)
+            table.append(tone + 1)
+    return np.array(table, dtype=np.int16)
+
+def toneIndices(values, lower, upper):
+    """
+    Returns the index of the library tone for each luminance value, or
+    OUT_OF_RANGE where the value falls outside the library (as getTone does).
+    uint8 data is mapped through a 256 entry lookup table.
+    """
+    values = np.asarray(values)
+    if values.dtype == np.uint8:
+        return _toneLookup(lower, tuple(upper))[values]
+
+    # Luminance is truncated to int before comparing, as in getTone
+    with np.errstate(invalid='ignore'):
+        truncated = np.trunc(values)
+        indices = np.searchsorted(upper, truncated, side='left').astype(np.int16)
+        indices[(truncated < lower) | (indices == len(upper))] = OUT_OF_RANGE
+    return indices
+
+@functools.lru_cache(maxsize=64)
+def _toneLookup(lower, upper):
+    """
+    Builds the tone index lookup table for every uint8 luminance value
+    """
+    return toneIndices(np.arange(256, dtype=np.float64), lower, np.array(upper))
+
+def quantizeTones(values, toneLibrary, scaleDict, scale):
+    """
+    Maps an array of luminance values to rescaled midi tones in one call.
+    Values outside the tone library are returned as OUT_OF_RANGE.
+    """
+    midiTones, lower, upper = toneBounds(toneLibrary)
+    # Trailing entry makes OUT_OF_RANGE (-1) indices map to themselves
+    table = np.append(rescaleTable(midiTones, scaleDict, scale), OUT_OF_RANGE)
+    return table[toneIndices(values, lower, upper)]
+
+def dropEmptyCells(values):
+    """
+    Returns grid values without their empty cells, whose luminance is NaN.
+    Cells are only empty when there are more squares than pixels on a side.
+    """
+    values = np.asarray(values)
+    luminance = values[:, -1] if values.ndim > 1 else values
+    return values[~np.isnan(luminance)]
+
+def moveToneScale(values, toneLibrary, scaleDict, scale):
+    """
+    Returns the luminance values rescaled to midi tones in the current scale
+    """
+    #scaleDict contains the midivalues for the scale, and the music notes in order
+    # Midi values and notes are key value pairs
+    with metrics.stage('moveToneScale', count=len(values)):
+        rescaledTones = quantizeTones(values, toneLibrary, scaleDict, scale)
+
+    outOfRange = np.flatnonzero(rescaledTones == OUT_OF_RANGE)
+    if len(outOfRange):
+        raise ValueError("Luminance value {} is outside the tone range".format(
+            np.asarray(values)[outOfRange[0]]))
     return rescaledTones
 
 def getTone(lib, val):
     """
     Returns tone from tone lib associated with particular lum val
     """
-    for tone in lib:
-        if lib[tone]['tone'][0] <= int(val) <= lib[tone]['tone'][1]:
-            return tone
+    midiTones, lower, upper = toneBounds(lib)
+    index = toneIndices(np.array([val], dtype=np.float64), lower, upper)[0]
+    if index != OUT_OF_RANGE:
+        return midiTones[index].item()
+
+def writeCsvHeader(myFile):
+    """
+    Writes the column headers of the midi values csv
+    """
+    myFile.write("{0},{1},{2},{3},{4}\n".format("Index", "Luminance", "RescaledTone", "MusicNote", "Scale"))
 
-def saveMidiValues(folder, meanLuminanceVals, convertedTone, scaleDict, scale, fileName):
+def writeMidiValues(myFile, meanLuminanceVals, convertedTone, scaleDict, scale, startIndex=0):
+    """
+    Write luminance, converted midi values, and associated music note rows.
+    Columns are formatted in bulk: the tone, note and scale text is looked up
+    per distinct tone, and where luminance takes few distinct values (uint8
+    pixels, or color pixel means) the row text after the index is looked up
+    per distinct (luminance, tone) pair, so only the index is formatted per row.
+    """
+    values = np.asarray(meanLuminanceVals)
+    tones = np.asarray(convertedTone)
+    if not len(values):
+        return
+
+    # Text after the luminance column for each midi tone
+    toneText = [None] * 128
+    for tone in np.unique(tones).tolist():
+        toneText[tone] = ",{0},{1},{2}\n".format(tone, scaleDict[tone], scale)
+    indexText = map(str, range(startIndex, startIndex + len(values)))
+
+    distinct = None
+    if values.dtype == np.uint8:
+        distinct, keys = np.arange(256), values
+    elif len(values) >= 1024:
+        distinct, keys = np.unique(values, return_inverse=True)
+        if len(distinct) * 4 > len(values):
+            distinct = None
+
+    if distinct is not None:
+        luminanceText = _luminanceText(distinct)
+        keys = keys.astype(np.int64) * 128 + tones
+        rowText = {}
+        for key in np.unique(keys).tolist():
+            rowText[key] = "," + luminanceText[key // 128] + toneText[key % 128]
+        rows = [index + rowText[key] for index, key in zip(indexText, keys.tolist())]
+    else:
+        rows = [index + "," + luminance + toneText[tone]
+                for index, luminance, tone in zip(indexText, _luminanceText(values), tones.tolist())]
+    myFile.write("".join(rows))
+
+def _luminanceText(values):
+    """
+    Formats luminance values as str() formats each numpy value
+    """
+    if values.dtype in (np.float64, np.int64):
+        # Python floats and ints format the same as their numpy scalars
+        return list(map(repr, values.tolist()))
+    return list(map(str, values))
+
+# Fixed width records of the binary csv sidecar
+SIDECAR_DTYPE = np.dtype([('index', '<u8'), ('luminance', '<f4'), ('tone', 'u1')])
+
+def openSidecar(folder, fileName, count):
+    """
+    Creates a memory mapped .npy sidecar for count csv rows, holding the
+    index, luminance (float32) and rescaled tone (uint8) of each row.
+    Readers can open it with np.load(path, mmap_mode='r').
+    """
+    return np.lib.format.open_memmap("./{}/{}.npy".format(folder, fileName), mode='w+',
+                                     dtype=SIDECAR_DTYPE, shape=(count,))
+
+def writeSidecar(sidecar, meanLuminanceVals, convertedTone, startIndex=0):
+    """
+    Fills sidecar records from startIndex
+    """
+    rows = slice(startIndex, startIndex + len(meanLuminanceVals))
+    sidecar['index'][rows] = np.arange(rows.start, rows.stop)
+    sidecar['luminance'][rows] = meanLuminanceVals
+    sidecar['tone'][rows] = convertedTone
+
+def saveMidiValues(folder, meanLuminanceVals, convertedTone, scaleDict, scale, fileName, sidecar=False):
     """
     Save raw luminance, converted midi values, and associated music note as csv
+    Optionally also save them as a binary .npy sidecar
     """
-    with open("./{}/{}.csv".format(folder, fileName), "w") as myFile:
-        # Write column headers
-        myFile.write("{0},{1},{2},{3},{4}\n".format("Index", "Luminance", "RescaledTone", "MusicNote", "Scale"))
-        # Write values
-        for index, eachVal in enumerate(meanLuminanceVals):
-            tone = convertedTone[index]
-            myFile.write("{0},{1},{2},{3},{4}\n".format(index, eachVal, tone, scaleDict[tone], scale))
+    csvPath = "./{}/{}.csv".format(folder, fileName)
+    with metrics.stage('saveMidiValues', count=len(meanLuminanceVals)) as stage:
+        with open(csvPath, "w") as myFile:
+            writeCsvHeader(myFile)
+            # Write values
+            writeMidiValues(myFile, meanLuminanceVals, convertedTone, scaleDict, scale)
+        stage['bytesWritten'] = metrics.fileSize(csvPath)
+
+        if sidecar:
+            records = openSidecar(folder, fileName, len(meanLuminanceVals))
+            writeSidecar(records, meanLuminanceVals, convertedTone)
+            records.flush()
+            stage['bytesWritten'] += records.nbytes
 
-def makeMidi(fileName, toneLibrary, tones):
+def newMidi(fileName):
     """
-    Makes the midi file for a given set of tones
+    Creates a single track midiutil midi file named after the image
     """
-    # Create midi file
+    from midiutil.MidiFile import MIDIFile
+
     tempMIDI = MIDIFile(1)
     track    = 0
-    channel  = 0
     time     = 0    # In beats
     tempo    = 60   # In BPM
-    volume   = 100  # 0-127, as per the MIDI standard
     
     # Create the trackname and temp
     tempMIDI.addTrackName(track, time, fileName)
     tempMIDI.addTempo(track, time, tempo)
-    
+    return tempMIDI
+
+def addMidiNotes(tempMIDI, tones, startIndex=0):
+    """
+    Adds tones to the midiutil track, one note every half beat from startIndex
+    """
+    track    = 0
+    channel  = 0
+    time     = 0    # In beats
+    volume   = 100  # 0-127, as per the MIDI standard
+
     # Add each tone from the current image
-    for index, tone in enumerate(tones):
+    for index, tone in enumerate(tones, startIndex):
         # Set duration 
         duration = .5
         # Set interval between tones
         toneInterval = (index) * duration
         # Add note to track
         tempMIDI.addNote(track, channel, tone, time + toneInterval, duration, volume)
-        
-    # Write the midi track to a file
+
+def writeMidi(tempMIDI, fileName):
+    """
+    Writes the midiutil track to the midiFiles folder
+    """
     with open("midiFiles/{}.mid".format(fileName), "wb") as midiFile:
         tempMIDI.writeFile(midiFile)
 
-if __name__ == "__main__":
+def addToneNotes(writer, tones, startIndex=0):
+    """
+    Adds tones to the open midiWriter track, one note every half beat from
+    startIndex
+    """
+    duration = .5
+    volume   = 100  # 0-127, as per the MIDI standard
+    starts = np.arange(startIndex, startIndex + len(tones)) * duration
+    writer.addNotes(tones, starts, duration, volume)
+
+def writeToneMidi(midiFile, trackName, tones, compactor=None):
+    """
+    Writes a single track midi file of tones, one every half beat, to an
+    open binary file, compacting the notes with compactor if given
+    """
+    writer = MidiWriter(midiFile, tempo=60)
+    writer.startTrack(trackName)
+    if compactor is not None:
+        compactor.addTones(writer, tones)
+        compactor.close(writer)
+    else:
+        addToneNotes(writer, tones)
+    writer.close()
+
+def newCompactor(compact, total):
+    """
+    Returns a NoteCompactor for compactOptions, decimating enough to write
+    at most maxNotes notes from total tones, or None without options
+    """
+    if not compact:
+        return None
+    return NoteCompactor(compact.get('merge', False),
+                         decimateFactor(compact.get('decimate', 1), total, compact.get('maxNotes')),
+                         compact.get('policy', 'first'), compact.get('maxNoteBeats'))
+
+def reportCompaction(compactor, stage):
+    """
+    Prints the compression the compactor achieved and adds its counts to
+    the metrics stage
+    """
+    print("Compacted {} tones into {} midi notes, {:.1f} times fewer".format(
+        compactor.tonesIn, compactor.notesOut, compactor.ratio()))
+    stage['notesWritten'] = compactor.notesOut
+
+def makeMidi(fileName, toneLibrary, tones, reference=False, compact=None):
+    """
+    Makes the midi file for a given set of tones. The reference flag builds
+    the file with midiutil rather than the bulk midiWriter encoder, and
+    ignores compact, the compactOptions.
+    """
+    with metrics.stage('makeMidi', count=len(tones)) as stage:
+        if reference:
+            tempMIDI = newMidi(fileName)
+            addMidiNotes(tempMIDI, tones)
+            writeMidi(tempMIDI, fileName)
+        else:
+            compactor = newCompactor(compact, len(tones))
+            with open("midiFiles/{}.mid".format(fileName), "wb") as midiFile:
+                writeToneMidi(midiFile, fileName, tones, compactor)
+            if compactor is not None:
+                reportCompaction(compactor, stage)
+        stage['bytesWritten'] = metrics.fileSize("midiFiles/{}.mid".format(fileName))
+
+def makeWav(fileName, tones, noteSeconds=0.5):
+    """
+    Renders the tones to a WAV file in the audioFiles folder, one every
+    noteSeconds (0.5 times notes as in the midi file)
+    """
+    from audio import writeWav
+
+    wavPath = "audioFiles/{}.wav".format(fileName)
+    with metrics.stage('makeWav', count=len(tones)) as stage:
+        writeWav(wavPath, tones, noteSeconds)
+        stage['bytesWritten'] = metrics.fileSize(wavPath)
+
+def writeChannelOutputs(myFile, midiFile, trackName, channelValues, luminanceTones, scaleDict, clip=0):
+    """
+    Writes a midi file with a track for each of red, green and blue, then
+    the luminance tones, and a csv of every track's values and notes. Each
+    colour track has its own tone range, clipped by clip percent, and a
+    scale picked from the channel's mean as mean red picks the image scale.
+    Greyscale images only get the luminance track.
+    """
+    tracks = []
+    if channelValues.shape[1] > 3:
+        for channel, channelName in enumerate(CHANNEL_NAMES):
+            values = channelValues[:, channel]
+            minTone, maxTone, toneInc = ToneStats().update(values).toneRange(clip)
+            scaleNote, scale, midiNotes, musicNotes = getScale(np.nanmean(values))
+            channelDict = dict(zip(midiNotes, musicNotes))
+            toneLibrary = setToneLib(midiNotes, musicNotes, minTone, toneInc)
+            luminance = values if not clip else np.clip(values, minTone, maxTone)
+            tracks.append((channelName, values, moveToneScale(luminance, toneLibrary, channelDict, scale),
+                           channelDict))
+    tracks.append(('Luminance', channelValues[:, -1], luminanceTones, scaleDict))
+
+    myFile.write(",".join(["Index"] + ["{0},{0}Tone,{0}Note".format(track[0]) for track in tracks]) + "\n")
+    columns = [np.arange(len(channelValues)).tolist()]
+    for channelName, values, tones, notes in tracks:
+        columns += [values.tolist(), tones.tolist(), [notes.get(tone, '') for tone in tones.tolist()]]
+    rowFormat = ",".join(["{}"] * len(columns)) + "\n"
+    myFile.write("".join(rowFormat.format(*row) for row in zip(*columns)))
+
+    writer = MidiWriter(midiFile, numTracks=len(tracks), tempo=60)
+    for channelName, values, tones, notes in tracks:
+        writer.startTrack("{} {}".format(trackName, channelName.lower()))
+        addToneNotes(writer, tones)
+        writer.endTrack()
+    writer.close()
+
+def makeChannelMidi(fileName, channelValues, luminanceTones, scaleDict, clip=0):
+    """
+    Writes midiFiles/NAME_channels.mid, with a track per channel, and its
+    csv to the imageData folder
+    """
+    channelName = fileName + "_channels"
+    midiPath = "midiFiles/{}.mid".format(channelName)
+    csvPath = "imageData/{}.csv".format(channelName)
+    with metrics.stage('makeChannelMidi', count=channelValues.size) as stage:
+        with open(csvPath, "w") as myFile, open(midiPath, "wb") as midiFile:
+            writeChannelOutputs(myFile, midiFile, fileName, channelValues, luminanceTones, scaleDict, clip)
+        stage['bytesWritten'] = metrics.fileSize(midiPath) + metrics.fileSize(csvPath)
 
-    args = parser.parse_args()
+def writePixelOutputs(myFile, midiFile, image, toneLibrary, scaleDict, scale, scaleNote, trackName,
+                      chunkRows=64, clipRange=None, records=None, keepTones=False, audio=None, compactor=None):
+    """
+    Streams the image pixels through tone rescaling into open csv and midi
+    files, and the sidecar records and WavRenderer audio if given, one block
+    of rows at a time. Midi notes are compacted by compactor, if given.
+    Returns all the tones as uint8 if keepTones, otherwise None.
+    """
+    writeCsvHeader(myFile)
+    writer = MidiWriter(midiFile, tempo=60)
+    writer.startTrack(trackName)
+
+    index = 0
+    keptTones = []
+    for chunk in iterPixelChunks(image, chunkRows):
+        luminance = chunk if clipRange is None else np.clip(chunk, *clipRange)
+        convertedTones = moveToneScale(luminance, toneLibrary, scaleDict, scale)
+        writeMidiValues(myFile, chunk, convertedTones, scaleDict, scaleNote, index)
+        if records is not None:
+            writeSidecar(records, chunk, convertedTones, index)
+        if compactor is not None:
+            compactor.addTones(writer, convertedTones)
+        else:
+            addToneNotes(writer, convertedTones, index)
+        if audio is not None:
+            audio.addTones(convertedTones)
+        if keepTones:
+            # Midi notes fit in a byte
+            keptTones.append(convertedTones.astype(np.uint8))
+        index += len(chunk)
+    if compactor is not None:
+        compactor.close(writer)
+    writer.close()
+
+    if keepTones:
+        return np.concatenate(keptTones) if keptTones else np.zeros(0, dtype=np.uint8)
+
+def sonifyPixels(folder, image, toneLibrary, scaleDict, scale, scaleNote, fileName, chunkRows=64, clipRange=None,
+                 sidecar=False, wav=None, compact=None):
+    """
+    Streams the image pixels through tone rescaling into the csv and midi
+    outputs, one block of rows at a time, so no per-pixel list is built.
+    Luminance is clipped to clipRange, if given, before rescaling.
+    If wav is given, the tones are also streamed to audioFiles as WAV
+    audio, wav seconds per note, or as many as fit if wav is 'fit'. The WAV
+    size is checked before any output is opened. compact holds the compactOptions for the
+    midi notes.
+    """
+    if wav:
+        from audio import FIT, WavRenderer, noteSecondsFor
+        noteSeconds = noteSecondsFor(image.shape[0] * image.shape[1], wav)
+        if wav == FIT and noteSeconds < 0.5:
+            print("{}: {:.4f} seconds per WAV note".format(fileName, noteSeconds))
+        wav = noteSeconds
+
+    records = None
+    if sidecar:
+        records = openSidecar(folder, fileName, image.shape[0] * image.shape[1])
+
+    csvPath = "./{}/{}.csv".format(folder, fileName)
+    midiPath = "midiFiles/{}.mid".format(fileName)
+    wavPath = "audioFiles/{}.wav".format(fileName)
+    with metrics.stage('sonifyPixels', count=image.shape[0] * image.shape[1]) as stage:
+        audio = WavRenderer(wavPath, wav) if wav else None
+        compactor = newCompactor(compact, image.shape[0] * image.shape[1])
+        with open(csvPath, "w") as myFile, open(midiPath, "wb") as midiFile:
+            writePixelOutputs(myFile, midiFile, image, toneLibrary, scaleDict, scale, scaleNote, fileName,
+                              chunkRows=chunkRows, clipRange=clipRange, records=records, audio=audio,
+                              compactor=compactor)
+        if compactor is not None:
+            reportCompaction(compactor, stage)
+        if audio is not None:
+            audio.close()
+        if records is not None:
+            records.flush()
+        stage['bytesWritten'] = metrics.fileSize(csvPath) + metrics.fileSize(midiPath)
+        if records is not None:
+            stage['bytesWritten'] += records.nbytes
+        if wav:
+            stage['bytesWritten'] += metrics.fileSize(wavPath)
+
+def getImageList(fileName):
+    """
+    Returns (image path, greyscale flag) pairs from the image file list
+    """
+    imageList = []
+    for line in getImagePaths(fileName):
+        if not line:
+            continue
+        imagePath, greyScale = line.split(',')
+        imageList.append((imagePath, bool(int(greyScale.strip()))))
+    return imageList
+
+def imageName(fileName):
+    """
+    Returns the name used for an image's output files
+    """
+    return os.path.basename(fileName).split('.')[0]
+
+def getScale(meanRed):
+    """
+    Returns the scale name, scale, midi tones and music notes selected by
+    the mean red value of an image
+    """
+    scaleIndex = currentScale(meanRed)
+    scaleNote = list(scales.keys())[scaleIndex]
+    scale = scales[scaleNote]
+    midiNotes, musicNotes = calculateScale(scale['offset'])
+    return scaleNote, scale, midiNotes, musicNotes
+
+def reducedDecodeError(image, edges, exactImage, nSquares=20):
+    """
+    Returns the largest difference between the grid means of a reduced
+    image, with its cell edges, and of the full resolution image
+    """
+    return np.nanmax(np.abs(gridMeans(image, nSquares, edges) - gridMeans(exactImage, nSquares)))
+
+def checkReducedDecode(fileName, nSquares=20, minCellPixels=32):
+    """
+    Returns the largest difference between the reduced and full resolution
+    grid means of an image, and the reducedErrorBound
+    """
+    image, meanRed, fullShape = readImageReduced(fileName, nSquares, minCellPixels)
+    edges = (reducedCellEdges(fullShape[0], image.shape[0], nSquares),
+             reducedCellEdges(fullShape[1], image.shape[1], nSquares))
+    error = reducedDecodeError(image, edges, readImage(fileName)[0], nSquares)
+    return error, reducedErrorBound(fullShape, image.shape, nSquares)
+
+def analyseImage(fileName, greyScale, pixel=False, nSquares=20, chunkRows=64, cache=None,
+                 fastDecode=False, fastTolerance=None, tiled=False, rawShape=None,
+                 render='full', previewSize=512, channels=False, decoded=None, submit=None):
+    """
+    Reads an image and returns its name, mean red value, luminance values,
+    their ToneStats and the decoded image. Pixel mode only keeps the
+    luminance range. When the values are found in the FeatureCache the image
+    is not decoded, and None is returned in its place.
+    fastDecode reads grid images at reduced resolution. If fastTolerance is
+    given, the full resolution means are also worked out and used instead
+    when the reduced ones differ by more than fastTolerance.
+    tiled memory maps the image where the format allows and reads it in
+    strips, returning the mapped array. Grid images are only drawn as
+    previews in tiled mode. render is 'full', 'preview' or 'none'.
+    channels returns grid values with a column per channel, then luminance,
+    as channelMeans does. The stats are of the luminance.
+    decoded is the (image, meanRed) readImage already returned for the
+    file, used in place of reading it again. submit is passed on to
+    getGridValues to render grid images elsewhere.
+    """
+    name = imageName(fileName)
+    with metrics.image(name, 'analyse'):
+        fastDecode = fastDecode and not pixel and not tiled
+        channels = channels and not pixel
+        if cache is not None:
+            cacheKey = cache.key(fileName, pixel, nSquares, greyScale, fastDecode, channels, rawShape)
+            with metrics.stage('cacheGet') as stage:
+                cached = cache.get(cacheKey)
+                stage['hit'] = cached is not None
+            if cached is not None:
+                values, meanRed, stats = cached
+                return name, meanRed, values, stats, None
+
+        if tiled:
+            image = openImageArray(fileName, rawShape)
+            values = {}
+            if pixel:
+                meanRed = tiledMeanRed(image)
+                stats = getPixelValues(image, values, name, chunkRows=chunkRows)
+            else:
+                values[name], meanRed = tiledGridMeans(image, nSquares, channels=channels)
+                luminance = values[name][:, -1] if channels else values[name]
+                stats = ToneStats().update(luminance)
+                if render != 'none':
+                    (submit or _call)(saveGridImages, image, luminance, name, greyScale, nSquares, None,
+                                      previewSize)
+            if cache is not None:
+                cache.put(cacheKey, values[name], meanRed, stats)
+            return name, meanRed, values[name], stats, image
+
+        edges = None
+        if fastDecode:
+            image, meanRed, fullShape = readImageReduced(fileName, nSquares)
+            edges = (reducedCellEdges(fullShape[0], image.shape[0], nSquares),
+                     reducedCellEdges(fullShape[1], image.shape[1], nSquares))
+            print("Decoded {} at {}x{}, cell mean error bound {:.2f}".format(
+                fileName, image.shape[1], image.shape[0], reducedErrorBound(fullShape, image.shape, nSquares)))
+
+            if fastTolerance is not None:
+                exactImage, exactRed = readImage(fileName)
+                error = reducedDecodeError(image, edges, exactImage, nSquares)
+                print("Reduced decode error for {}: {:.2f}".format(fileName, error))
+                if error > fastTolerance:
+                    image, meanRed, edges = exactImage, exactRed, None
+        elif decoded is not None:
+            image, meanRed = decoded
+        else:
+            # Grid values come with the mean red value, so readImage need not work it out
+            image, meanRed = readImage(fileName, withMeanRed=pixel)
+
+        values = {}
+        if pixel:
+            stats = getPixelValues(image, values, name, chunkRows=chunkRows)
+        else:
+            gridValues, gridRed = getGridValues(image, values, name, greyScale=greyScale, nSquares=nSquares,
+                                                edges=edges, render=render, previewSize=previewSize,
+                                                channels=channels, submit=submit)
+            stats = ToneStats().update(gridValues[:, -1] if channels else gridValues)
+            if meanRed is None:
+                meanRed = gridRed
+
+        if cache is not None:
+            cache.put(cacheKey, values[name], meanRed, stats)
+        return name, meanRed, values[name], stats, image
+
+def writeOutputs(fileName, name, meanRed, values, minTone, maxTone, toneInc, pixel=False,
+                 chunkRows=64, reference=False, image=None, clip=False, tiled=False, rawShape=None,
+                 sidecar=False, wav=None, compact=None):
+    """
+    Rescales an image's luminance values to tones in its scale, then writes
+    the csv and midi file. Pixel mode streams the pixels from image, which
+    is read (or memory mapped, if tiled) again if not given. With clip,
+    luminance outside the tone range is clipped to it rather than rejected.
+    sidecar also writes the csv columns to a binary .npy file. If wav is
+    given, the tones are rendered to a WAV file, wav seconds per note, or
+    as many as fit if wav is 'fit'.
+    Grid values analysed with channels also get a midi track per channel.
+    compact holds the compactOptions for the midi notes.
+    """
+    with metrics.image(name, 'output'):
+        clipRange = (minTone, maxTone) if clip else None
+        scaleNote, scale, midiNotes, musicNotes = getScale(meanRed)
+        scaleDict = dict(zip(midiNotes, musicNotes))
+
+        # Create the tone library based on current picture values
+        toneLibrary = setToneLib(midiNotes, musicNotes, minTone, toneInc)
 
+        if pixel:
+            if image is None and tiled:
+                image = openImageArray(fileName, rawShape)
+            elif image is None:
+                image, meanRed = readImage(fileName)
+            # Pixel tones are streamed into the csv and midi file together
+            sonifyPixels("imageData", image, toneLibrary, scaleDict, scale, scaleNote, name, chunkRows=chunkRows,
+                         clipRange=clipRange, sidecar=sidecar, wav=wav, compact=compact)
+            return
+
+        channelValues = None
+        values = dropEmptyCells(values)
+        if np.ndim(values) > 1:
+            channelValues, values = values, values[:, -1]
+
+        # Rescale tones
+        luminance = values if clipRange is None else np.clip(values, *clipRange)
+        covertedTones = moveToneScale(luminance, toneLibrary, scaleDict, scale)
+        if wav:
+            from audio import noteSecondsFor
+            wav = noteSecondsFor(len(covertedTones), wav)
+
+        # save midi data as csv
+        saveMidiValues("imageData", values, covertedTones, scaleDict, scaleNote, name, sidecar)
+
+        # make the midi file
+        makeMidi(name, toneLibrary, covertedTones, reference=reference, compact=compact)
+        if wav:
+            makeWav(name, covertedTones, wav)
+        if channelValues is not None:
+            makeChannelMidi(name, channelValues, covertedTones, scaleDict, clip)
+
+def _analyseJob(job):
+    """
+    Process pool wrapper around analyseImage. Errors are returned rather
+    than raised, so one bad image does not abort the batch.
+    """
+    fileName, greyScale, options = job
+    try:
+        name, meanRed, values, stats, image = analyseImage(fileName, greyScale, **options)
+        return name, meanRed, values, stats, None
+    except Exception as e:
+        return None, None, None, None, e
+
+def _outputJob(job):
+    """
+    Process pool wrapper around writeOutputs, returning any error
+    """
+    args, kwargs = job
+    try:
+        writeOutputs(*args, **kwargs)
+    except Exception as e:
+        return e
+
+def toneRanges(imageStats, rangeMode='sofar', clip=0):
+    """
+    Returns the (min, max, increment) tone range for each image's ToneStats,
+    in order. 'sofar' uses the images up to and including each one, 'global'
+    uses the whole batch for every image.
+    """
+    running = ToneStats()
+    ranges = []
+    for stats in imageStats:
+        running.merge(stats)
+        if rangeMode == 'sofar':
+            ranges.append(reportToneRange(running, clip))
+    if rangeMode == 'global' and imageStats:
+        ranges = [reportToneRange(running, clip)] * len(imageStats)
+    return ranges
+
+def runBatch(imageList, args, cache=None, rawShape=None):
+    """
+    Sonifies the image list across a pool of args.jobs processes.
+    Images are analysed in parallel, then each image's tone range is worked
+    out from the merged stats in list order, as the serial loop does, before
+    the outputs are written in parallel. Returns the images that failed.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    failed = []
+    # Workers write their own metrics to the same file
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=metrics.configure,
+                             initargs=metrics.settings()) as pool:
+        options = analyseOptions(args, cache, rawShape)
+        analyseJobs = [(fileName, greyScale, options) for fileName, greyScale in imageList]
+        analyses = []
+        for (fileName, greyScale), analysis in zip(imageList, pool.map(_analyseJob, analyseJobs)):
+            if analysis[-1] is not None:
+                print("Could not sonify {}: {}".format(fileName, analysis[-1]))
+                failed.append(fileName)
+            else:
+                analyses.append((fileName,) + analysis[:-1])
+
+        ranges = toneRanges([analysis[-1] for analysis in analyses], args.range, args.clip)
+        outputJobs = []
+        for (fileName, name, meanRed, values, stats), (minTone, maxTone, toneInc) in zip(analyses, ranges):
+            outputJobs.append(((fileName, name, meanRed, values, minTone, maxTone, toneInc),
+                               outputOptions(args, rawShape)))
+
+        errors = pool.map(_outputJob, outputJobs)
+        for job, error in zip(outputJobs, errors):
+            fileName = job[0][0]
+            if error is not None:
+                print("Could not sonify {}: {}".format(fileName, error))
+                failed.append(fileName)
+            else:
+                print("Sonification of {} complete!".format(fileName))
+    return failed
+
+def runPipeline(imageList, args, cache=None, rawShape=None):
+    """
+    Sonifies the image list in this process, overlapping decoding, analysis
+    and output writes. The next args.prefetch images are decoded on threads
+    while the current one is analysed here, and grid images, csv and midi
+    files are written by args.writers threads. Decoded images, including
+    those waiting on their writes, are held to args.max_inflight_mb. Tone
+    ranges are worked out in list order, as the serial loop does. Images are
+    decoded on demand instead when cached, tiled or fast decoded. Returns
+    the images that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from pipeline import MemoryBudget, Prefetcher, releaseWhenDone
+
+    prefetch = cache is None and not args.tiled and not args.fast_decode
+
+    def load(item):
+        return readImage(item[0], withMeanRed=args.pixel) if prefetch else None
+
+    def estimate(item):
+        return imageBytes(item[0]) if prefetch else 0
+
+    budget = MemoryBudget(int(args.max_inflight_mb * 1024 * 1024))
+    options = outputOptions(args, rawShape)
+    failed = []
+    outputs = []
+    runningStats = ToneStats()
+    # Images waiting for the whole batch range, in global range mode
+    pending = []
+    with ThreadPoolExecutor(max_workers=max(1, args.writers)) as writers:
+        images = Prefetcher(imageList, load, estimate, budget, ahead=max(0, args.prefetch),
+                            threads=max(1, args.prefetch))
+        for (fileName, greyScale), decoded, error, nbytes in images:
+            print("\n******** Sonifying {} ********\n".format(fileName))
+            # Writes that hold the decoded image, which is released once they finish
+            tasks = []
+
+            def submit(function, *args):
+                tasks.append(writers.submit(function, *args))
+
+            try:
+                if error is not None:
+                    raise error
+                name, meanRed, values, stats, image = analyseImage(fileName, greyScale, decoded=decoded,
+                                                                   submit=submit,
+                                                                   **analyseOptions(args, cache, rawShape))
+            except Exception as e:
+                print("Could not sonify {}: {}".format(fileName, e))
+                failed.append(fileName)
+                releaseWhenDone(budget, nbytes, tasks)
+                continue
+            decoded = None
+            print("The mean red value in the image: %d" % (meanRed))
+
+            runningStats.merge(stats)
+            if args.range == 'global':
+                pending.append((fileName, name, meanRed, values, tasks))
+            else:
+                minTone, maxTone, toneInc = reportToneRange(runningStats, args.clip)
+                submit(functools.partial(writeOutputs, image=image, **options), fileName, name, meanRed,
+                       values, minTone, maxTone, toneInc)
+            outputs.append((fileName, tasks))
+            image = None
+            releaseWhenDone(budget, nbytes, tasks)
+
+        if pending:
+            # Second pass with the range over the whole batch
+            print("\n******** Batch luminance range ********\n")
+            minTone, maxTone, toneInc = reportToneRange(runningStats, args.clip)
+            for fileName, name, meanRed, values, tasks in pending:
+                tasks.append(writers.submit(writeOutputs, fileName, name, meanRed, values, minTone, maxTone,
+                                            toneInc, **options))
+
+        # Grid image renders fail their image too, as in the serial loop
+        for fileName, tasks in outputs:
+            try:
+                for future in tasks:
+                    future.result()
+            except Exception as e:
+                print("Could not sonify {}: {}".format(fileName, e))
+                failed.append(fileName)
+                continue
+            print("Sonification of {} complete!".format(fileName))
+    print("Most decoded image data in flight: {:.1f} MB".format(budget.peak / (1024 * 1024)))
+    return failed
+
+def watchParams(args):
+    """
+    Returns the options that change an image's outputs, as a string kept in
+    the watch manifest
+    """
+    return json.dumps({'pixel': args.pixel, 'squares': args.squares, 'clip': args.clip,
+                       'fastDecode': args.fast_decode, 'fastTolerance': args.fast_tolerance,
+                       'rawShape': args.raw_shape, 'render': args.render, 'previewSize': args.preview_size,
+                       'greyScale': args.watch_grey, 'sidecar': args.sidecar, 'wav': args.wav,
+                       'channels': args.channels, 'compact': compactOptions(args), 'midiutil': args.midiutil},
+                      sort_keys=True)
+
+def scanFolder(folder):
+    """
+    Returns (path, stat) for the images in a folder, in name order
+    """
+    images = []
+    for entry in os.scandir(folder):
+        if entry.is_file() and not entry.name.startswith('.') \
+                and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+            images.append((entry.path, entry.stat()))
+    return sorted(images)
+
+def watchFolder(args, cache=None, rawShape=None):
+    """
+    Sonifies the images in the watched folder that are new or have changed
+    since they were recorded in the manifest, every poll seconds. Each image
+    gets the tone range of every image recorded so far, as --range sofar
+    does, from the stats kept in the manifest. Images modified in the last
+    settle seconds are left for the next scan, as they may still be being
+    written. Returns the exit status once interrupted, or after one scan
+    with --once.
+    """
+    import time
+    from manifest import Manifest
+
+    manifest = Manifest(args.manifest, watchParams(args))
+    runningStats = manifest.stats()
+    print("Watching {} ({} images recorded in {})".format(args.watch, len(manifest.entries), args.manifest))
+    try:
+        while True:
+            failed = sonified = 0
+            images = scanFolder(args.watch)
+            present = set(path for path, info in images)
+            for path in [path for path in manifest.entries if path not in present]:
+                manifest.remove(path)
+                runningStats = manifest.stats()
+
+            for path, info in images:
+                if time.time() - info.st_mtime < args.settle:
+                    continue
+                digest = manifest.needsUpdate(path, info)
+                if digest is None:
+                    continue
+
+                print("\n******** Sonifying {} ********\n".format(path))
+                try:
+                    name, meanRed, values, stats, image = analyseImage(path, args.watch_grey,
+                                                                       **analyseOptions(args, cache, rawShape))
+                    # A changed image replaces its old stats
+                    imageStats = stats.copy().merge(manifest.stats(exclude=path) if path in manifest.entries
+                                                    else runningStats)
+                    minTone, maxTone, toneInc = reportToneRange(imageStats, args.clip)
+                    writeOutputs(path, name, meanRed, values, minTone, maxTone, toneInc, image=image,
+                                 **outputOptions(args, rawShape))
+                except Exception as e:
+                    print("Could not sonify {}: {}".format(path, e))
+                    manifest.record(path, info, digest, error=e)
+                    failed += 1
+                    continue
+
+                replaced = path in manifest.entries
+                manifest.record(path, info, digest, stats, meanRed)
+                runningStats = manifest.stats() if replaced else runningStats.merge(stats)
+                sonified += 1
+
+            if sonified or failed:
+                print("\nSonified {} new or changed images, {} failed".format(sonified, failed))
+            if args.once:
+                return 1 if failed else 0
+            time.sleep(args.poll)
+    except KeyboardInterrupt:
+        return 0
+
+def main(argv=None):
+    """
+    Runs the script, returning the exit status
+    """
+    args = parseArgs(argv)
+
+    metrics.configure(args.metrics, traceMemory=bool(args.profile))
+    if not args.profile:
+        return run(args)
+
+    profiler = metrics.startProfile()
+    try:
+        return run(args)
+    finally:
+        metrics.stopProfile(profiler, args.profile)
+
+def run(args):
+    """
+    Sonifies the images in images.txt with the parsed command line options,
+    returning the exit status
+    """
     if args.pixel:
         print("\nCreating midi from pixels...")
     else:
@@ -297,58 +1578,100 @@ if __name__ == "__main__":
     makeFolder("gridImages")
     makeFolder("imageData")
     makeFolder("midiFiles")
+    if args.wav:
+        makeFolder("audioFiles")
+
+    cache = None
+    if args.cache:
+        from featureCache import FeatureCache
+        cache = FeatureCache(args.cache, maxBytes=int(args.cache_size * 1024 * 1024))
 
-    for fileName in getImagePaths("./images.txt"):
-        fileName, greyScale = fileName.split(',')
-        greyScale = bool(int(greyScale.strip()))
+    rawShape = parseShape(args.raw_shape) if args.raw_shape else None
+    if args.watch:
+        return watchFolder(args, cache, rawShape)
 
+    imageList = getImageList("./images.txt")
+    if args.jobs > 1:
+        failed = runBatch(imageList, args, cache, rawShape)
+        if failed:
+            print("\n{} of {} images failed: {}".format(len(failed), len(imageList), ", ".join(failed)))
+        return 1 if failed else 0
+    if args.pipeline:
+        failed = runPipeline(imageList, args, cache, rawShape)
+        if failed:
+            print("\n{} of {} images failed: {}".format(len(failed), len(imageList), ", ".join(failed)))
+        return 1 if failed else 0
+
+    failed = []
+    runningStats = ToneStats()
+    # Images waiting for the whole batch range, in global range mode
+    pending = []
+    for fileName, greyScale in imageList:
         print("\n******** Sonifying {} ********\n".format(fileName))
         print("Greyscale image? ", greyScale)                   
-        # Read image 
-        image, meanRed = readImage(fileName)
+        try:
+            # Read image and get values for conversion to midi tones
+            name, meanRed, values, stats, image = analyseImage(fileName, greyScale,
+                                                               **analyseOptions(args, cache, rawShape))
+        except Exception as e:
+            print("Could not sonify {}: {}".format(fileName, e))
+            failed.append(fileName)
+            continue
         print("The mean red value in the image: %d" % (meanRed))
         
         # Set scale information
-        scaleIndex = currentScale(meanRed)
-        scaleNote = list(scales.keys())[scaleIndex]
-        scale = scales[scaleNote]
+        scaleNote, scale, midiNotes, musicNotes = getScale(meanRed)
         print("The tones will be rescaled to ", scaleNote)
-
-        midiNotes, musicNotes = calculateScale(scale['offset'])
-        scaleDict = dict(zip(midiNotes, musicNotes))
         print("Miditone scale: \t", midiNotes)
         print("Resequenced note scale: ", musicNotes)
         print("Mean red value selected the {} scale: {}".format(scaleNote, scale['scale']))
 
-        # Get image name
-        name = fileName.split('.')[0].split('/')[-1]
-        
-        # Get values for conversion to midi tones
-        tones[name] = []
-        [getGridValues, getPixelValues][args.pixel](image, tones, name, greyScale=greyScale)
-        
-        # Get tone ranges
-        minTone, maxTone, toneInc = toneRange(tones)
+        runningStats.merge(stats)
+        if args.range == 'global':
+            pending.append((fileName, name, meanRed, values))
+            continue
 
-        # Create the tone library based on current picture values
-        toneLibrary = setToneLib(midiNotes, musicNotes, minTone, toneInc)
-
-        # Rescale tones
-        covertedTones = moveToneScale(tones[name], toneLibrary, scaleDict, scale)
+        # Get tone ranges
+        minTone, maxTone, toneInc = reportToneRange(runningStats, args.clip)
 
-        # save midi data as csv
-        saveMidiValues("imageData", tones[name], covertedTones, scaleDict, scaleNote, name)
-        
         import datetime
         start = datetime.datetime.now()
         print("\nscript execution stared at:", start)
         print("script run times")
-        
-        # make the midi file
-        makeMidi(name, toneLibrary, covertedTones)
+
+        try:
+            writeOutputs(fileName, name, meanRed, values, minTone, maxTone, toneInc, image=image,
+                         **outputOptions(args, rawShape))
+        except Exception as e:
+            print("Could not sonify {}: {}".format(fileName, e))
+            failed.append(fileName)
+            continue
 
         end = datetime.datetime.now()
         print("Script execution ended at:", end)
         total_time = end - start
         print("Script totally ran for :", total_time)
-        print("\n******** Sonification of {} complete! ********\n".format(fileName))     
\ No newline at end of file
+        print("\n******** Sonification of {} complete! ********\n".format(fileName))
+
+    if pending:
+        # Second pass with the range over the whole batch
+        print("\n******** Batch luminance range ********\n")
+        minTone, maxTone, toneInc = reportToneRange(runningStats, args.clip)
+        for fileName, name, meanRed, values in pending:
+            try:
+                writeOutputs(fileName, name, meanRed, values, minTone, maxTone, toneInc,
+                             **outputOptions(args, rawShape))
+            except Exception as e:
+                print("Could not sonify {}: {}".format(fileName, e))
+                failed.append(fileName)
+                continue
+            print("Sonification of {} complete!".format(fileName))
+
+    if failed:
+        print("\n{} of {} images failed: {}".format(len(failed), len(imageList), ", ".join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,130 @@
+"""
+Persisted record of the images sonified from a watched folder.
+
+Each image's entry holds its size, mtime, content hash, the parameters it
+was processed with and its ToneStats, so unchanged images are skipped with
+one stat call and the cumulative luminance range is rebuilt from the stored
+stats, without reading any image again. The manifest is a json lines
+journal: recording an image appends one line, flushed to disk, so a crash
+loses at most the image being processed. On loading, a torn last line is
+ignored and the journal is rewritten compactly, replacing the old file
+atomically.
+"""
+import os
+import json
+import tempfile
+
+from featureCache import fileHash
+from toneStats import ToneStats
+
+
+class Manifest:
+    """
+    The entries of a manifest file, by image path, for one set of
+    processing parameters. Entries made with other parameters are stale.
+    """
+
+    def __init__(self, fileName, params):
+        self.fileName = fileName
+        self.params = params
+        self.entries = {}
+        folder = os.path.dirname(fileName)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.load()
+        self.compact()
+
+    def load(self):
+        """
+        Reads the journal, later lines replacing earlier ones
+        """
+        self.entries = {}
+        if not os.path.exists(self.fileName):
+            return
+        with open(self.fileName, 'r') as myFile:
+            for line in myFile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line torn by a crash
+                    continue
+                if entry.get('removed'):
+                    self.entries.pop(entry['path'], None)
+                else:
+                    self.entries[entry['path']] = entry
+
+    def compact(self):
+        """
+        Rewrites the journal with one line per entry
+        """
+        folder = os.path.dirname(self.fileName) or '.'
+        handle, tempPath = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as myFile:
+                for entry in self.entries.values():
+                    myFile.write(json.dumps(entry) + "\n")
+                myFile.flush()
+                os.fsync(myFile.fileno())
+            os.replace(tempPath, self.fileName)
+        except BaseException:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+
+    def _append(self, entry):
+        with open(self.fileName, 'a') as myFile:
+            myFile.write(json.dumps(entry) + "\n")
+            myFile.flush()
+            os.fsync(myFile.fileno())
+
+    def needsUpdate(self, path, info):
+        """
+        Returns the content hash of an image if it is new, changed or was
+        processed with other parameters, or None if its entry is current.
+        The file is only hashed when its size or mtime changed; a file
+        touched without changing is recorded with its new mtime.
+        """
+        entry = self.entries.get(path)
+        if entry is not None and entry['params'] == self.params and entry['size'] == info.st_size \
+                and entry['mtime'] == info.st_mtime_ns:
+            return None
+
+        digest = fileHash(path)
+        if entry is not None and entry['params'] == self.params and entry['hash'] == digest:
+            self.record(path, info, digest, entry.get('stats') and ToneStats.fromDict(entry['stats']),
+                        entry.get('meanRed'), entry.get('error'))
+            return None
+        return digest
+
+    def record(self, path, info, digest, stats=None, meanRed=None, error=None):
+        """
+        Records an image as processed, with its stats, or the error it
+        failed with so it is not retried until it changes
+        """
+        entry = {'path': path, 'size': info.st_size, 'mtime': info.st_mtime_ns, 'hash': digest,
+                 'params': self.params}
+        if stats is not None:
+            entry['stats'] = stats.toDict()
+            entry['meanRed'] = float(meanRed)
+        if error is not None:
+            entry['error'] = str(error)
+        self.entries[path] = entry
+        self._append(entry)
+
+    def remove(self, path):
+        """
+        Drops the entry of an image that has been deleted
+        """
+        if self.entries.pop(path, None) is not None:
+            self._append({'path': path, 'removed': True})
+
+    def stats(self, exclude=None):
+        """
+        Returns the merged ToneStats of every current entry, except that of
+        the exclude path
+        """
+        stats = ToneStats()
+        for path, entry in self.entries.items():
+            if 'stats' in entry and entry['params'] == self.params and path != exclude:
+                stats.merge(ToneStats.fromDict(entry['stats']))
+        return stats
@@ -0,0 +1,180 @@
+"""
+Per-stage timings and sizes of the sonification pipeline, written as json
+lines to a metrics file.
+
+Pipeline functions wrap their work in stage(). Inside an image() block the
+stages are totalled per image and written as one line when the block ends,
+other stages are written as they finish. Nothing is written until
+configure() is given a file. Allocation peaks are recorded while tracemalloc
+is tracing, which --profile turns on.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+import tracemalloc
+
+_metricsFile = None
+# The open image block and stages of each thread, so images can be
+# sonified on several threads at once
+_local = threading.local()
+
+
+def _openStages():
+    """
+    Returns this thread's open stages, innermost last, as
+    [record, allocation peak of finished children]
+    """
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def configure(metricsFile=None, traceMemory=False):
+    """
+    Sets the file metrics are appended to, and starts tracemalloc if
+    traceMemory. Also used as the initializer of worker processes.
+    """
+    global _metricsFile
+    _metricsFile = metricsFile
+    if traceMemory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def settings():
+    """
+    Returns the configure() arguments in use, for passing to workers
+    """
+    return _metricsFile, tracemalloc.is_tracing()
+
+def enabled():
+    """
+    Returns True when metrics are being written
+    """
+    return _metricsFile is not None
+
+def fileSize(path):
+    """
+    Returns the size of a file in bytes, or 0 if it does not exist
+    """
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        # Not a file on disk, such as an in-memory buffer
+        return 0
+
+def peakRss():
+    """
+    Returns the peak resident memory of this process in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def emit(record):
+    """
+    Appends a record to the metrics file as one json line
+    """
+    if _metricsFile is None:
+        return
+    # Appending whole lines keeps records from worker processes apart
+    with open(_metricsFile, 'a') as myFile:
+        myFile.write(json.dumps(record) + "\n")
+
+@contextlib.contextmanager
+def image(name, phase):
+    """
+    Totals the stages run inside the block for image name, then writes them
+    as one record. phase tells apart the analysis and output of an image.
+    """
+    outer = getattr(_local, 'image', None)
+    record = {'image': name, 'phase': phase, 'pid': os.getpid(), 'stages': {}}
+    _local.image = record
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        _local.image = outer
+        record['seconds'] = time.perf_counter() - start
+        record['peakRssMB'] = peakRss()
+        emit(record)
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Times the block as stage name. The yielded dict holds the stage's
+    fields, such as bytesRead, bytesWritten and count, which the block may
+    add to. Time spent in nested stages is included.
+    """
+    record = dict(fields)
+    stack = _openStages()
+    # Traced memory is process wide, so allocation peaks from several threads overlap
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            # The enclosing stage keeps the peak reached before this one
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+    stack.append([record, 0])
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        _, childPeak = stack.pop()
+        if tracing:
+            peak = max(childPeak, tracemalloc.get_traced_memory()[1])
+            record['allocPeakBytes'] = max(0, peak - current)
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+        _record(name, record)
+
+def _record(name, record):
+    image = getattr(_local, 'image', None)
+    if image is None:
+        record.update({'stage': name, 'pid': os.getpid()})
+        emit(record)
+        return
+
+    # Repeated stages, such as per chunk tone rescaling, are summed
+    totals = image['stages'].setdefault(name, {'calls': 0})
+    totals['calls'] += 1
+    for field, value in record.items():
+        if field == 'allocPeakBytes':
+            totals[field] = max(totals.get(field, 0), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            totals[field] = totals.get(field, 0) + value
+        else:
+            totals[field] = value
+
+def startProfile():
+    """
+    Starts and returns a cProfile profiler
+    """
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stopProfile(profiler, statsFile, top=15):
+    """
+    Stops the profiler, saves its stats to statsFile for pstats or
+    snakeviz, and prints the slowest functions and, if tracemalloc is
+    tracing, the largest allocation sites
+    """
+    import pstats
+
+    profiler.disable()
+    profiler.dump_stats(statsFile)
+    print("\nProfile saved to {}".format(statsFile))
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        print("Traced memory: {:.1f} MB now, {:.1f} MB peak".format(current / 1e6, peak / 1e6))
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:top]:
+            print(stat)
@@ -0,0 +1,227 @@
+"""
+Writes standard midi files directly from numpy note arrays.
+
+Produces the same bytes as midiutil's MIDIFile (format 1, a tempo track
+followed by note tracks) for note sequences without overlapping notes of
+the same pitch, but encodes the events in bulk and streams each track to
+disk, backpatching the track length when the track is closed.
+"""
+import struct
+
+import numpy as np
+
+TICKS_PER_QUARTERNOTE = 960
+
+# Event kinds, in the order midiutil writes events sharing a tick
+NOTE_OFF = 0
+NOTE_ON = 1
+
+
+def timeToTicks(times):
+    """
+    Converts times in beats to midi ticks, truncating as midiutil does
+    """
+    return (np.asarray(times, dtype=np.float64) * TICKS_PER_QUARTERNOTE).astype(np.int64)
+
+def varLengthBytes(value):
+    """
+    Returns a single integer as midi variable length bytes
+    """
+    groups, lengths = encodeVarLength(np.array([value]))
+    return bytes(groups[0, 4 - lengths[0]:])
+
+def encodeVarLength(values):
+    """
+    Encodes an array of non-negative integers as midi variable length
+    quantities. Returns the bytes as a (len(values), 4) uint8 array, aligned
+    right, and the number of bytes used by each value.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) and (values.min() < 0 or values.max() >= 1 << 28):
+        raise ValueError("Variable length values must be between 0 and 2^28")
+
+    # Seven bits per byte, most significant group first
+    shifts = np.array([21, 14, 7, 0])
+    groups = ((values[:, np.newaxis] >> shifts) & 0x7F).astype(np.uint8)
+    lengths = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+
+    # Every byte but the last carries the continuation bit
+    continued = np.arange(4) < 3
+    groups[:, continued] |= 0x80
+    return groups, lengths
+
+def encodeEvents(ticks, status, pitches, velocities, previousTick=0):
+    """
+    Encodes time ordered channel events as midi track bytes.
+    Returns the bytes and the tick of the last event.
+    """
+    if not len(ticks):
+        return b"", previousTick
+
+    deltas = np.diff(ticks, prepend=previousTick)
+    groups, lengths = encodeVarLength(deltas)
+
+    # Each event is its delta time followed by three data bytes
+    eventLengths = lengths + 3
+    ends = np.cumsum(eventLengths)
+    starts = ends - eventLengths
+    data = np.empty(ends[-1], dtype=np.uint8)
+
+    for byte in range(4):
+        # Right aligned delta bytes, so byte i is used when lengths > 3 - i
+        used = lengths > 3 - byte
+        data[starts[used] + byte - (4 - lengths[used])] = groups[used, byte]
+    data[ends - 3] = status
+    data[ends - 2] = pitches
+    data[ends - 1] = velocities
+    return data.tobytes(), int(ticks[-1])
+
+
+class MidiWriter:
+    """
+    Streams a format 1 midi file with a tempo track and numTracks note tracks.
+    Tracks are written one after another: startTrack, addNotes as often as
+    needed with non-decreasing start times, then endTrack.
+    """
+
+    def __init__(self, midiFile, numTracks=1, tempo=60):
+        self.midiFile = midiFile
+        self.numTracks = numTracks
+        self.tracksWritten = 0
+        self._trackStart = None
+
+        self.midiFile.write(b"MThd" + struct.pack('>LHHH', 6, 1, numTracks + 1, TICKS_PER_QUARTERNOTE))
+        tempoData = b"\x00\xff\x51\x03" + struct.pack('>L', int(60000000 / tempo))[1:]
+        self._writeChunk(tempoData + b"\x00\xff\x2f\x00")
+
+    def _writeChunk(self, data):
+        self.midiFile.write(b"MTrk" + struct.pack('>L', len(data)) + data)
+
+    def startTrack(self, trackName):
+        """
+        Opens the next note track, named trackName
+        """
+        if self._trackStart is not None:
+            raise RuntimeError("The previous track has not been ended")
+        if self.tracksWritten == self.numTracks:
+            raise RuntimeError("All {} tracks have been written".format(self.numTracks))
+
+        # The chunk length is written as a placeholder and patched in endTrack
+        self.midiFile.write(b"MTrk\x00\x00\x00\x00")
+        self._trackStart = self.midiFile.tell()
+        self._lastTick = 0
+        self._noteCount = 0
+        self._lastStart = 0
+        # Events that may still be preceded by events of later notes
+        self._pending = np.zeros((0, 6), dtype=np.int64)
+
+        name = trackName.encode("ISO-8859-1")
+        self.midiFile.write(b"\x00\xff\x03" + varLengthBytes(len(name)) + name)
+
+    def addNotes(self, pitches, starts, durations, velocities=100, channel=0):
+        """
+        Adds notes to the open track. Starts and durations are in beats,
+        velocities may be a single value or one per note.
+        """
+        starts = timeToTicks(starts)
+        if not len(starts):
+            return
+        if starts[0] < self._lastStart or np.any(np.diff(starts) < 0):
+            raise ValueError("Note start times must not decrease")
+
+        count = len(starts)
+        pitches = np.broadcast_to(np.asarray(pitches, dtype=np.int64), (count,))
+        velocities = np.broadcast_to(np.asarray(velocities, dtype=np.int64), (count,))
+        ends = starts + timeToTicks(np.broadcast_to(durations, (count,)))
+        order = np.arange(self._noteCount, self._noteCount + count)
+
+        # Columns: tick, kind, order, status, pitch, velocity
+        onEvents = np.column_stack([starts, np.full(count, NOTE_ON), order,
+                                    np.full(count, 0x90 | channel), pitches, velocities])
+        offEvents = np.column_stack([ends, np.full(count, NOTE_OFF), order,
+                                     np.full(count, 0x80 | channel), pitches, velocities])
+        events = np.concatenate([self._pending, onEvents, offEvents])
+
+        self._noteCount += count
+        self._lastStart = starts[-1]
+        # Later notes start at or after the last start, so anything before it is final
+        self._flush(events, events[:, 0] < self._lastStart)
+
+    def addEvents(self, times, pitches, noteOn, velocities=100, channel=0):
+        """
+        Adds note on (where noteOn is True) and note off events to the open
+        track, for notes whose end is not known when they start. Times are
+        in beats and must not decrease, also across calls to addNotes.
+        """
+        ticks = timeToTicks(times)
+        if not len(ticks):
+            return
+        if ticks[0] < self._lastStart or np.any(np.diff(ticks) < 0):
+            raise ValueError("Event times must not decrease")
+
+        count = len(ticks)
+        noteOn = np.broadcast_to(np.asarray(noteOn, dtype=bool), (count,))
+        pitches = np.broadcast_to(np.asarray(pitches, dtype=np.int64), (count,))
+        velocities = np.broadcast_to(np.asarray(velocities, dtype=np.int64), (count,))
+        order = np.arange(self._noteCount, self._noteCount + count)
+
+        # Columns: tick, kind, order, status, pitch, velocity
+        events = np.column_stack([ticks, np.where(noteOn, NOTE_ON, NOTE_OFF), order,
+                                  np.where(noteOn, 0x90, 0x80) | channel, pitches, velocities])
+        events = np.concatenate([self._pending, events])
+
+        self._noteCount += count
+        self._lastStart = ticks[-1]
+        self._flush(events, events[:, 0] < self._lastStart)
+
+    def _flush(self, events, ready):
+        flushed = events[ready]
+        self._pending = events[~ready]
+
+        # Sort on (tick, kind, order): note offs come before note ons on the same tick
+        flushed = flushed[np.lexsort((flushed[:, 2], flushed[:, 1], flushed[:, 0]))]
+        data, self._lastTick = encodeEvents(flushed[:, 0], flushed[:, 3], flushed[:, 4],
+                                            flushed[:, 5], self._lastTick)
+        self.midiFile.write(data)
+
+    def endTrack(self):
+        """
+        Writes the remaining events and the end of track, then patches the
+        track length
+        """
+        if self._trackStart is None:
+            raise RuntimeError("No track has been started")
+        if len(self._pending):
+            self._flush(self._pending, np.ones(len(self._pending), dtype=bool))
+        self.midiFile.write(b"\x00\xff\x2f\x00")
+
+        trackEnd = self.midiFile.tell()
+        self.midiFile.seek(self._trackStart - 4)
+        self.midiFile.write(struct.pack('>L', trackEnd - self._trackStart))
+        self.midiFile.seek(trackEnd)
+
+        self._trackStart = None
+        self.tracksWritten += 1
+
+    def close(self):
+        """
+        Checks every declared track has been written
+        """
+        if self._trackStart is not None:
+            self.endTrack()
+        if self.tracksWritten != self.numTracks:
+            raise RuntimeError("Only {} of {} tracks were written".format(self.tracksWritten, self.numTracks))
+
+
+def writeMidiFile(midiFile, trackName, pitches, starts, durations, velocities=100, tempo=60, chunkSize=1 << 20):
+    """
+    Writes a single track midi file from note arrays, chunkSize notes at a time
+    """
+    writer = MidiWriter(midiFile, tempo=tempo)
+    writer.startTrack(trackName)
+    for chunk in range(0, len(pitches), chunkSize):
+        noteSlice = slice(chunk, chunk + chunkSize)
+        writer.addNotes(pitches[noteSlice], starts[noteSlice],
+                        np.broadcast_to(durations, len(pitches))[noteSlice],
+                        np.broadcast_to(velocities, len(pitches))[noteSlice])
+    writer.close()
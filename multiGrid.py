@@ -0,0 +1,122 @@
+"""
+Sonifies one image at several grid layouts, each layout a track of one midi
+file.
+
+A summed-area table is built once from the image, and every layout's cell
+means are read from it, so extra resolutions cost the same however large
+the image is. Layouts are uniform grids at each --resolutions size and,
+with --quadtree, a quadtree that splits busy cells. Every track lasts as
+long as the layout with the most cells would at half a beat per note, so
+coarse layouts hold longer notes. The tone range and scale are shared by
+all the layouts.
+
+    python multiGrid.py images/blue.jpg --resolutions 8,20,64 --quadtree 6
+"""
+import os
+import argparse
+
+import numpy as np
+
+import metrics
+import imageProcessor as ip
+from midiWriter import MidiWriter
+from toneStats import ToneStats
+from summedArea import SummedAreaTable, gridCells, quadtreeCells, shuffleCells
+
+parser = argparse.ArgumentParser(description='Sonify an image at several grid layouts, one midi track each')
+parser.add_argument('image', help='Image to sonify')
+parser.add_argument('--name', help='Name of the output files, the image name with _multi by default', default=None)
+parser.add_argument('--resolutions', help='Grid squares per side of each uniform layout, comma separated', default='8,20,64')
+parser.add_argument('--quadtree', help='Also add a quadtree layout this many levels deep', default=0, type=int)
+parser.add_argument('--min-std', help='Luminance standard deviation above which quadtree cells are split', default=8.0, type=float)
+parser.add_argument('--shuffle', help='Play the cells of each layout in a random order from this seed', default=None, type=int)
+parser.add_argument('--clip', help='Percent of luminance values clipped from each end of the tone range', default=0, type=float)
+
+
+def parseResolutions(text):
+    """
+    Returns the grid sizes in a comma separated list
+    """
+    return [int(size) for size in text.split(',') if size.strip()]
+
+def imageLayers(table, resolutions=(8, 20, 64), quadtreeDepth=0, minStd=8.0, seed=None):
+    """
+    Returns (layer name, cells) for each grid resolution and the quadtree,
+    leaving out empty cells. With seed, each layer's cells are shuffled.
+    """
+    rows, cols = table.shape
+    layers = [('{0}x{0}'.format(size), gridCells(ip.cellEdges(rows, size), ip.cellEdges(cols, size)))
+              for size in resolutions]
+    if quadtreeDepth:
+        layers.append(('quadtree', quadtreeCells(table, quadtreeDepth, minStd)))
+
+    result = []
+    for layer, cells in layers:
+        cells = cells[table.areas(cells) > 0]
+        if not len(cells):
+            raise ValueError("The {} layout has no cells in a {}x{} image".format(layer, cols, rows))
+        if seed is not None:
+            cells = shuffleCells(cells, seed)
+        result.append((layer, cells))
+    return result
+
+def writeLayer(myFile, layer, cells, values, tones, scaleDict):
+    """
+    Writes a csv row for each cell of a layer
+    """
+    rows = ["{},{},{},{},{},{},{},{},{}\n".format(layer, index, x1, x2, y1, y2, value, tone, scaleDict.get(tone, ''))
+            for index, ((x1, x2, y1, y2), value, tone) in enumerate(zip(cells.tolist(), values.tolist(),
+                                                                         tones.tolist()))]
+    myFile.write("".join(rows))
+
+def sonifyLayers(fileName, name=None, resolutions=(8, 20, 64), quadtreeDepth=0, minStd=8.0, seed=None, clip=0,
+                 dataFolder="imageData", midiFolder="midiFiles"):
+    """
+    Sonifies an image at each layout into dataFolder/NAME.csv, listing every
+    cell, and midiFolder/NAME.mid, one track per layout. Returns the layer
+    names and cell counts.
+    """
+    name = name or ip.imageName(fileName) + '_multi'
+    with metrics.image(name, 'multiGrid'):
+        image, meanRed = ip.readImage(fileName)
+        with metrics.stage('summedAreaTable', count=image.shape[0] * image.shape[1]):
+            table = SummedAreaTable(image, squares=bool(quadtreeDepth))
+        layers = imageLayers(table, resolutions, quadtreeDepth, minStd, seed)
+        with metrics.stage('layerMeans', count=sum(len(cells) for layer, cells in layers)):
+            layerMeans = [table.means(cells) for layer, cells in layers]
+
+        stats = ToneStats()
+        for means in layerMeans:
+            stats.update(means)
+        minTone, maxTone, toneInc = ip.reportToneRange(stats, clip)
+        scaleNote, scale, midiNotes, musicNotes = ip.getScale(meanRed)
+        scaleDict = dict(zip(midiNotes, musicNotes))
+        toneLibrary = ip.setToneLib(midiNotes, musicNotes, minTone, toneInc)
+
+        totalBeats = 0.5 * max(len(cells) for layer, cells in layers)
+        with open(os.path.join(dataFolder, name + '.csv'), 'w') as myFile, \
+                open(os.path.join(midiFolder, name + '.mid'), 'wb') as midiFile:
+            myFile.write("Layer,Index,RowStart,RowEnd,ColumnStart,ColumnEnd,Luminance,RescaledTone,MusicNote\n")
+            writer = MidiWriter(midiFile, numTracks=len(layers), tempo=60)
+            for (layer, cells), means in zip(layers, layerMeans):
+                luminance = means if not clip else np.clip(means, minTone, maxTone)
+                tones = ip.moveToneScale(luminance, toneLibrary, scaleDict, scale)
+                writeLayer(myFile, layer, cells, means, tones, scaleDict)
+
+                duration = totalBeats / len(cells)
+                writer.startTrack('{} {}'.format(name, layer))
+                writer.addNotes(tones, np.arange(len(tones)) * duration, duration)
+                writer.endTrack()
+            writer.close()
+    return [(layer, len(cells)) for layer, cells in layers]
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    ip.makeFolder("imageData")
+    ip.makeFolder("midiFiles")
+    layers = sonifyLayers(args.image, args.name, parseResolutions(args.resolutions), args.quadtree, args.min_std,
+                          args.shuffle, args.clip)
+    for layer, cells in layers:
+        print("{}: {} cells".format(layer, cells))
@@ -0,0 +1,164 @@
+"""
+Compacts tone sequences into fewer, longer midi notes.
+
+Flat areas of an image, such as skies and backgrounds, give long runs of the
+same tone. Merging each run into one note keeps the music the same while
+the midi file shrinks. Decimation goes further, reducing each block of
+decimate tones to one tone with a policy, so the note rate drops by that
+factor. Tones are streamed in chunks, and runs and blocks carry on across
+chunk boundaries.
+
+    compactor = NoteCompactor(merge=True, decimate=10, policy='median')
+    compactor.addTones(writer, tones)
+    compactor.close(writer)
+    compactor.ratio()
+"""
+import numpy as np
+
+from midiWriter import TICKS_PER_QUARTERNOTE
+
+# Longest note whose end a midi delta time can reach
+MAX_NOTE_BEATS = ((1 << 28) - 1) // TICKS_PER_QUARTERNOTE
+
+# Reduce each block of decimated tones to one tone. Every policy returns a
+# tone from the block, so decimated tones stay in the scale.
+DECIMATE_POLICIES = {
+    'first': lambda blocks: blocks[:, 0],
+    'median': lambda blocks: np.sort(blocks, axis=1)[:, (blocks.shape[1] - 1) // 2],
+    'min': lambda blocks: blocks.min(axis=1),
+    'max': lambda blocks: blocks.max(axis=1),
+}
+
+
+def decimateFactor(decimate=1, total=None, maxNotes=None):
+    """
+    Returns the decimation needed to write at most maxNotes notes from total
+    tones, or decimate if that is larger
+    """
+    if maxNotes and total:
+        decimate = max(decimate, -(-total // maxNotes))
+    return max(1, int(decimate))
+
+def splitRuns(starts, lengths, maxLength):
+    """
+    Splits runs longer than maxLength into consecutive runs of at most
+    maxLength. Returns the run each new run came from, and their starts and
+    lengths.
+    """
+    pieces = np.ceil(lengths / maxLength).astype(np.int64)
+    runs = np.repeat(np.arange(len(starts)), pieces)
+    # Position of each piece within its run
+    offsets = np.arange(len(runs)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    newStarts = starts[runs] + offsets * maxLength
+    return runs, newStarts, np.minimum(maxLength, starts[runs] + lengths[runs] - newStarts)
+
+
+class NoteCompactor:
+    """
+    Adds tones to an open MidiWriter track as compacted notes, one track
+    per compactor. Each tone
+    lasts noteBeats. decimate reduces blocks of that many tones to one tone
+    lasting the whole block, chosen by policy (see DECIMATE_POLICIES). merge
+    joins runs of the same tone into one note, of at most maxNoteBeats if
+    given, and never longer than MAX_NOTE_BEATS. Counts of tones in and notes out are kept for ratio.
+    """
+
+    def __init__(self, merge=True, decimate=1, policy='first', maxNoteBeats=None, noteBeats=0.5, velocity=100):
+        if policy not in DECIMATE_POLICIES:
+            raise ValueError("Unknown decimation policy {}".format(policy))
+        self.merge = merge
+        self.decimate = max(1, int(decimate))
+        self.policy = DECIMATE_POLICIES[policy]
+        self.noteBeats = noteBeats
+        maxNoteBeats = min(maxNoteBeats or MAX_NOTE_BEATS, MAX_NOTE_BEATS)
+        # Longest note in tones, a whole number of decimation blocks
+        self.maxRun = max(1, int(maxNoteBeats // (noteBeats * self.decimate))) * self.decimate
+        self.velocity = velocity
+
+        self.tonesIn = 0
+        self.notesOut = 0
+        # Tones waiting to fill a decimation block
+        self._leftover = np.zeros(0, dtype=np.int64)
+        # Decimated steps so far, and the open run as (tone, first step)
+        self._steps = 0
+        self._run = None
+
+    def addTones(self, writer, tones):
+        """
+        Adds the next tones in order to the writer's open track
+        """
+        tones = np.asarray(tones, dtype=np.int64)
+        self.tonesIn += len(tones)
+        if self.decimate > 1:
+            tones = np.concatenate([self._leftover, tones])
+            used = len(tones) - len(tones) % self.decimate
+            self._leftover = tones[used:]
+            tones = self.policy(tones[:used].reshape(-1, self.decimate))
+        self._addSteps(writer, tones)
+
+    def _addSteps(self, writer, tones):
+        if not len(tones):
+            return
+        steps = self._steps + np.arange(len(tones))
+        self._steps += len(tones)
+        if not self.merge:
+            self._write(writer, tones, steps * self.decimate, np.full(len(tones), self.decimate))
+            return
+
+        # First step of each run of equal tones, continuing the open run
+        changes = np.flatnonzero(np.diff(tones)) + 1
+        runStarts = np.concatenate([[0], changes])
+        runTones = tones[runStarts]
+        runSteps = steps[runStarts]
+        if self._run is not None:
+            if self._run[0] == runTones[0]:
+                runSteps[0] = self._run[1]
+            else:
+                runTones = np.concatenate([[self._run[0]], runTones])
+                runSteps = np.concatenate([[self._run[1]], runSteps])
+
+        # The last run may carry on into the next tones
+        ends = np.append(runSteps[1:], self._steps)
+        self._write(writer, runTones[:-1], runSteps[:-1] * self.decimate,
+                    (ends[:-1] - runSteps[:-1]) * self.decimate)
+        self._run = (runTones[-1], runSteps[-1])
+
+    def _write(self, writer, tones, starts, lengths):
+        # starts and lengths count tones in, so partial blocks stay whole numbers
+        if not len(tones):
+            return
+        if lengths.max() > self.maxRun:
+            runs, starts, lengths = splitRuns(starts, lengths, self.maxRun)
+            tones = tones[runs]
+        writer.addNotes(tones, starts * self.noteBeats, lengths * self.noteBeats, self.velocity)
+        self.notesOut += len(tones)
+
+    def close(self, writer):
+        """
+        Writes the open run and any partial decimation block, which becomes
+        a note only as long as its tones. The MidiWriter track is left open.
+        """
+        end = self._steps * self.decimate
+        partial = None
+        if len(self._leftover):
+            tone = self.policy(self._leftover[np.newaxis])[0]
+            length = len(self._leftover)
+            self._leftover = self._leftover[:0]
+            if self.merge and self._run is not None and self._run[0] == tone:
+                end += length
+            else:
+                partial = (tone, length)
+
+        if self._run is not None:
+            tone, step = self._run
+            self._run = None
+            start = step * self.decimate
+            self._write(writer, np.array([tone]), np.array([start]), np.array([end - start]))
+        if partial is not None:
+            self._write(writer, np.array([partial[0]]), np.array([end]), np.array([partial[1]]))
+
+    def ratio(self):
+        """
+        Returns the tones added per note written
+        """
+        return self.tonesIn / self.notesOut if self.notesOut else 0.0
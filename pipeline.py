@@ -0,0 +1,128 @@
+"""
+Building blocks for overlapping image decoding, analysis and output writes
+in one process.
+
+A MemoryBudget bounds the bytes of images in flight. A Prefetcher loads the
+next items of a list on background threads, in order, as far ahead as the
+budget allows, so the caller is rarely left waiting on a decode. Loads for
+later items never hold budget the next item needs, so a caller that only
+blocks on the next item cannot deadlock.
+"""
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MemoryBudget:
+    """
+    Counts bytes in use against maxBytes. A single request larger than
+    maxBytes is allowed once nothing else is in use, so it cannot stall.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.used = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def _fits(self, nbytes):
+        return self.used == 0 or self.used + nbytes <= self.maxBytes
+
+    def _take(self, nbytes):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+
+    def acquire(self, nbytes):
+        """
+        Waits until nbytes fit, then takes them
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(nbytes))
+            self._take(nbytes)
+
+    def tryAcquire(self, nbytes):
+        """
+        Takes nbytes if they fit now, returning whether they were taken
+        """
+        with self._condition:
+            if not self._fits(nbytes):
+                return False
+            self._take(nbytes)
+            return True
+
+    def release(self, nbytes):
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+
+class Prefetcher:
+    """
+    Iterates over (item, result, error, nbytes) for each item in order,
+    where result is load(item), run on one of threads background threads.
+    Up to ahead items are loaded in advance while their estimate(item)
+    bytes fit in the budget. The caller owns the bytes of each item it is
+    given and must release them to the budget when done with it.
+    """
+
+    def __init__(self, items, load, estimate, budget, ahead=2, threads=2):
+        self.items = list(items)
+        self.load = load
+        self.estimate = estimate
+        self.budget = budget
+        self.ahead = ahead
+        self.threads = threads
+
+    def _size(self, item):
+        try:
+            return self.estimate(item)
+        except Exception:
+            # Unreadable files fail in load, with nothing to hold
+            return 0
+
+    def __iter__(self):
+        pending = collections.deque()
+        nextItem = 0
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for index, item in enumerate(self.items):
+                if nextItem == index:
+                    # Only this item's own bytes are waited for
+                    nbytes = self._size(item)
+                    self.budget.acquire(nbytes)
+                    pending.append((pool.submit(self.load, item), nbytes))
+                    nextItem += 1
+                while nextItem < len(self.items) and nextItem <= index + self.ahead:
+                    nbytes = self._size(self.items[nextItem])
+                    if not self.budget.tryAcquire(nbytes):
+                        break
+                    pending.append((pool.submit(self.load, self.items[nextItem]), nbytes))
+                    nextItem += 1
+
+                future, nbytes = pending.popleft()
+                try:
+                    result, error = future.result(), None
+                except Exception as e:
+                    result, error = None, e
+                yield item, result, error, nbytes
+
+
+def releaseWhenDone(budget, nbytes, futures):
+    """
+    Releases nbytes to the budget once all the futures are done, or now if
+    there are none
+    """
+    if not futures:
+        budget.release(nbytes)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            budget.release(nbytes)
+
+    for future in futures:
+        future.add_done_callback(done)
@@ -0,0 +1,330 @@
+"""
+Long-running sonification server on localhost HTTP.
+
+Keeps warm worker threads, with imports and Sonifiers already set up, that
+take jobs from a bounded queue one at a time, so no job waits behind
+another while a worker is idle. When the queue is full new requests get
+503 with Retry-After, rather than piling up.
+
+    POST /sonify?name=blue&squares=20   image bytes in, midi bytes out,
+                                        with the stats in X-Sonify headers
+    POST /sonify?format=json            json with the stats, base64 midi and csv
+    GET  /stats                         queue depth, counts and latencies
+    GET  /health
+
+    python server.py --port 8765
+    python server.py --client images/blue.jpg images/MERS.jpg --output midiFiles
+"""
+import os
+import json
+import time
+import queue
+import base64
+import argparse
+import threading
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import metrics
+from sonifier import Sonifier
+
+parser = argparse.ArgumentParser(description='Sonification server')
+parser.add_argument('--host', help='Address to listen on', default='127.0.0.1')
+parser.add_argument('--port', help='Port to listen on', default=8765, type=int)
+parser.add_argument('--workers', help='Number of worker threads', default=2, type=int)
+parser.add_argument('--queue-size', help='Jobs that may wait before requests are refused', default=16, type=int)
+parser.add_argument('--timeout', help='Seconds a request waits for its result', default=300, type=float)
+parser.add_argument('--max-bytes', help='Largest image accepted, in MB', default=256, type=float)
+parser.add_argument('--metrics', help='File per-request metrics are appended to as json lines', default=None)
+parser.add_argument('--client', help='Send the listed images to a running server instead', default=False, action='store_true')
+parser.add_argument('--output', help='Folder the client saves midi files to', default='midiFiles')
+parser.add_argument('images', help='Images sent by the client', nargs='*')
+
+# Latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 1000
+
+
+class Job:
+    """
+    One image waiting to be sonified, with its Sonifier options and, once
+    done, its result or error
+    """
+
+    def __init__(self, data, name, options, greyScale=False):
+        self.data = data
+        self.name = name
+        self.options = options
+        self.greyScale = greyScale
+        self.queued = time.perf_counter()
+        self.waitSeconds = None
+        self.serviceSeconds = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SonifyService:
+    """
+    A bounded job queue served by worker threads, each taking the next
+    queued job when it is free
+    """
+
+    def __init__(self, workers=2, queueSize=16):
+        self.workers = workers
+        self.jobs = queue.Queue(maxsize=queueSize)
+        self._threads = []
+        self._sonifiers = {}
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.waitTimes = collections.deque(maxlen=LATENCY_WINDOW)
+        self.serviceTimes = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        Lets the workers finish the queued jobs, then stops them
+        """
+        for _ in self._threads:
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, data, name, options, greyScale=False):
+        """
+        Queues an image, returning its Job. Raises queue.Full when the
+        queue is full.
+        """
+        job = Job(data, name, options, greyScale)
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.counts['rejected'] += 1
+            raise
+        with self._lock:
+            self.counts['accepted'] += 1
+        return job
+
+    def sonifier(self, options):
+        """
+        Returns the Sonifier for a set of options, made on first use
+        """
+        key = tuple(sorted(options.items()))
+        with self._lock:
+            if key not in self._sonifiers:
+                self._sonifiers[key] = Sonifier(**options)
+            return self._sonifiers[key]
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            start = time.perf_counter()
+            job.waitSeconds = start - job.queued
+            try:
+                job.result = self.sonifier(job.options).sonify(job.data, job.name, job.greyScale)
+            except Exception as e:
+                job.error = e
+            job.serviceSeconds = time.perf_counter() - start
+            job.data = None
+            self._record(job)
+            job.done.set()
+
+    def _record(self, job):
+        with self._lock:
+            self.counts['failed' if job.error is not None else 'completed'] += 1
+            self.waitTimes.append(job.waitSeconds)
+            self.serviceTimes.append(job.serviceSeconds)
+        metrics.emit({'request': job.name, 'waitSeconds': job.waitSeconds, 'serviceSeconds': job.serviceSeconds,
+                      'queueDepth': self.jobs.qsize(), 'error': None if job.error is None else str(job.error)})
+
+    def stats(self):
+        """
+        Returns the queue depth, job counts and wait and service time
+        percentiles, in seconds
+        """
+        with self._lock:
+            waits = np.array(self.waitTimes)
+            services = np.array(self.serviceTimes)
+            stats = {'queueDepth': self.jobs.qsize(), 'queueSize': self.jobs.maxsize, 'workers': self.workers,
+                     'counts': dict(self.counts)}
+        for name, times in (('waitSeconds', waits), ('serviceSeconds', services)):
+            if len(times):
+                stats[name] = dict(zip(('p50', 'p95', 'p99', 'max'),
+                                       np.percentile(times, [50, 95, 99, 100]).tolist()))
+        return stats
+
+
+def parseOptions(query):
+    """
+    Returns the image name, Sonifier options, greyScale flag and response
+    format from a request's query parameters
+    """
+    params = urllib.parse.parse_qs(query)
+
+    def get(name, default, kind):
+        return kind(params[name][0]) if name in params else default
+
+    options = {'pixel': bool(get('pixel', 0, int)), 'nSquares': get('squares', 20, int),
+               'clip': get('clip', 0, float)}
+    return get('name', 'image', str), options, bool(get('greyscale', 0, int)), get('format', 'midi', str)
+
+def resultStats(result, job):
+    """
+    Returns the stats sent back with a result
+    """
+    minTone, maxTone, toneInc = result.toneRange
+    return {'name': result.name, 'meanRed': float(result.meanRed), 'scale': result.scaleNote,
+            'minTone': minTone, 'maxTone': maxTone, 'toneIncrement': toneInc, 'notes': int(len(result.tones)),
+            'waitSeconds': job.waitSeconds, 'serviceSeconds': job.serviceSeconds}
+
+
+class SonifyHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to a SonifyServer
+    """
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/stats':
+            self._sendJson(200, self.server.service.stats())
+        elif path == '/health':
+            self._sendJson(200, {'ok': True})
+        else:
+            self._sendJson(404, {'error': 'Unknown path {}'.format(path)})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/sonify':
+            self._sendJson(404, {'error': 'Unknown path {}'.format(url.path)})
+            return
+        try:
+            name, options, greyScale, responseFormat = parseOptions(url.query)
+        except ValueError as e:
+            self._sendJson(400, {'error': str(e)})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            self._sendJson(400, {'error': 'No image in the request body'})
+            return
+        if length > self.server.maxBytes:
+            self._sendJson(413, {'error': 'Image is larger than {} bytes'.format(self.server.maxBytes)})
+            return
+        data = self.rfile.read(length)
+
+        try:
+            job = self.server.service.submit(data, name, options, greyScale)
+        except queue.Full:
+            self._sendJson(503, {'error': 'Queue is full'}, {'Retry-After': '1'})
+            return
+
+        if not job.done.wait(self.server.resultTimeout):
+            self._sendJson(504, {'error': 'Timed out waiting for the result'})
+            return
+        if job.error is not None:
+            self._sendJson(422, {'error': 'Could not sonify {}: {}'.format(name, job.error)})
+            return
+
+        stats = resultStats(job.result, job)
+        if responseFormat == 'json':
+            stats.update({'midi': base64.b64encode(job.result.midi).decode('ascii'), 'csv': job.result.csv})
+            self._sendJson(200, stats)
+            return
+        headers = {'X-Sonify-' + key: str(value) for key, value in stats.items()}
+        self._send(200, job.result.midi, 'audio/midi', headers)
+
+    def _sendJson(self, status, data, headers=None):
+        self._send(status, json.dumps(data).encode(), 'application/json', headers)
+
+    def _send(self, status, body, contentType, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are counted in /stats rather than logged
+        pass
+
+
+class SonifyServer(ThreadingHTTPServer):
+    """
+    HTTP server passing sonify requests to a SonifyService
+    """
+    daemon_threads = True
+
+    def __init__(self, address, service, resultTimeout=300, maxBytes=256 * 1024 * 1024):
+        super().__init__(address, SonifyHandler)
+        self.service = service
+        # Not timeout, which BaseServer uses as the handle_request poll timeout
+        self.resultTimeout = resultTimeout
+        self.maxBytes = maxBytes
+
+
+def sonifyRemote(url, fileName, name=None, **params):
+    """
+    Stand-in client: sends an image file to a server and returns the midi
+    bytes and stats headers. Retries while the server's queue is full.
+    """
+    params['name'] = name or os.path.splitext(os.path.basename(fileName))[0]
+    with open(fileName, 'rb') as myFile:
+        data = myFile.read()
+    request = urllib.request.Request("{}/sonify?{}".format(url, urllib.parse.urlencode(params)), data=data,
+                                     headers={'Content-Type': 'application/octet-stream'})
+    while True:
+        try:
+            with urllib.request.urlopen(request) as response:
+                stats = {key[len('X-Sonify-'):]: value for key, value in response.headers.items()
+                         if key.startswith('X-Sonify-')}
+                return response.read(), stats
+        except urllib.error.HTTPError as e:
+            if e.code != 503:
+                raise
+            time.sleep(float(e.headers.get('Retry-After', 1)))
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    url = "http://{}:{}".format(args.host, args.port)
+
+    if args.client:
+        os.makedirs(args.output, exist_ok=True)
+        for fileName in args.images:
+            midi, stats = sonifyRemote(url, fileName)
+            path = os.path.join(args.output, stats['name'] + '.mid')
+            with open(path, 'wb') as midiFile:
+                midiFile.write(midi)
+            print("{} -> {} ({} notes, {} scale, {}s queued, {}s to sonify)".format(
+                fileName, path, stats['notes'], stats['scale'], stats['waitSeconds'], stats['serviceSeconds']))
+        raise SystemExit(0)
+
+    metrics.configure(args.metrics)
+    service = SonifyService(args.workers, args.queue_size).start()
+    server = SonifyServer((args.host, args.port), service, args.timeout, int(args.max_bytes * 1024 * 1024))
+    print("Sonifying on {} with {} workers".format(url, args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
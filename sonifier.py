@@ -0,0 +1,207 @@
+"""
+Sonifies single images in process, returning the outputs in memory.
+
+A Sonifier holds its settings and running luminance stats, so separate
+Sonifiers share no state and one Sonifier can be used from several threads
+at once. Nothing is written to disk unless SonifyResult.save is called.
+
+    sonifier = Sonifier(nSquares=20)
+    result = sonifier.sonify(open('images/blue.jpg', 'rb').read(), 'blue')
+    result.midi   # midi file bytes
+    result.csv    # csv text
+"""
+import io
+import os
+import threading
+
+import numpy as np
+
+import metrics
+import imageProcessor as ip
+from audio import FIT, WavRenderer, noteSecondsFor, writeWav
+from toneStats import ToneStats
+
+
+class SonifyResult:
+    """
+    The outputs for one image: its luminance values (None in pixel mode),
+    midi tones, (min, max, increment) tone range, scale name, csv text and
+    midi file bytes, and the WAV file bytes, grid images and per-channel
+    csv and midi file when they were rendered. compression is the tones per
+    midi note when the notes were compacted, otherwise None.
+    """
+
+    def __init__(self, name, meanRed, values, tones, toneRange, scaleNote, csv, midi,
+                 gridImage=None, redImage=None, wav=None, channelCsv=None, channelMidi=None,
+                 compression=None):
+        self.name = name
+        self.meanRed = meanRed
+        self.values = values
+        self.tones = tones
+        self.toneRange = toneRange
+        self.scaleNote = scaleNote
+        self.csv = csv
+        self.midi = midi
+        self.gridImage = gridImage
+        self.redImage = redImage
+        self.wav = wav
+        self.channelCsv = channelCsv
+        self.channelMidi = channelMidi
+        self.compression = compression
+
+    def save(self, dataFolder="imageData", midiFolder="midiFiles", imageFolder="gridImages",
+             audioFolder="audioFiles"):
+        """
+        Writes the csv, midi file and any WAV file, channel outputs and grid
+        images to the given folders, and returns the paths written
+        """
+        paths = [os.path.join(dataFolder, self.name + '.csv'), os.path.join(midiFolder, self.name + '.mid')]
+        for folder in (dataFolder, midiFolder):
+            os.makedirs(folder, exist_ok=True)
+        with open(paths[0], 'w') as myFile:
+            myFile.write(self.csv)
+        with open(paths[1], 'wb') as midiFile:
+            midiFile.write(self.midi)
+        if self.wav is not None:
+            os.makedirs(audioFolder, exist_ok=True)
+            paths.append(os.path.join(audioFolder, self.name + '.wav'))
+            with open(paths[-1], 'wb') as wavFile:
+                wavFile.write(self.wav)
+        if self.channelMidi is not None:
+            paths += [os.path.join(dataFolder, self.name + '_channels.csv'),
+                      os.path.join(midiFolder, self.name + '_channels.mid')]
+            with open(paths[-2], 'w') as myFile:
+                myFile.write(self.channelCsv)
+            with open(paths[-1], 'wb') as midiFile:
+                midiFile.write(self.channelMidi)
+
+        for name, image in ((self.name, self.gridImage), ('red' + self.name, self.redImage)):
+            if image is not None:
+                os.makedirs(imageFolder, exist_ok=True)
+                ip.saveImage(imageFolder, name, image)
+                paths.append(os.path.join(imageFolder, name + '.png'))
+        return paths
+
+
+class Sonifier:
+    """
+    Turns images into midi tones with fixed settings. rangeMode 'image'
+    sets each image's tone range from its own luminance; 'sofar' uses every
+    image this Sonifier has seen, as the command line does, in the order
+    the calls reach it. render is 'none', 'full' or 'preview'. wav also
+    renders the tones as WAV audio, 0.5 seconds per note if True (shorter
+    if needed to fit a WAV file), or wav seconds per note. channels adds a midi file with a track per channel
+    in grid mode, and compact holds the compactOptions for the midi notes.
+    """
+
+    def __init__(self, pixel=False, nSquares=20, chunkRows=64, rangeMode='image', clip=0,
+                 render='none', previewSize=512, wav=False, channels=False, compact=None):
+        if rangeMode not in ('image', 'sofar'):
+            raise ValueError("Unknown range mode {}".format(rangeMode))
+        if render not in ('none', 'full', 'preview'):
+            raise ValueError("Unknown render mode {}".format(render))
+        self.pixel = pixel
+        self.nSquares = nSquares
+        self.chunkRows = chunkRows
+        self.rangeMode = rangeMode
+        self.clip = clip
+        self.render = render
+        self.previewSize = previewSize
+        self.wav = FIT if wav is True else wav
+        self.channels = channels and not pixel
+        self.compact = compact
+        self.stats = ToneStats()
+        self._lock = threading.Lock()
+
+    def loadImage(self, image, withMeanRed=True):
+        """
+        Returns the pixel array and mean red value of an image given as a
+        path, encoded image bytes, a file object or an array. Without
+        withMeanRed, decoded images have a mean red value of None, as in
+        readImage.
+        """
+        if isinstance(image, np.ndarray):
+            meanRed = image[:, :, 0].mean() if image.ndim > 2 else 0
+            return image, meanRed
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            image = io.BytesIO(image)
+        return ip.readImage(image, withMeanRed=withMeanRed)
+
+    def toneRange(self, stats):
+        """
+        Returns the (min, max, increment) tone range for an image's stats
+        """
+        if self.rangeMode == 'image':
+            return stats.toneRange(self.clip)
+        with self._lock:
+            self.stats.merge(stats)
+            return self.stats.toneRange(self.clip)
+
+    def sonify(self, image, name='image', greyScale=False):
+        """
+        Sonifies an image and returns a SonifyResult. name is used as the
+        midi track name and for saved files.
+        """
+        with metrics.image(name, 'sonify'):
+            # Grid values come with the mean red value, so it is only read for pixel mode
+            pixels, meanRed = self.loadImage(image, withMeanRed=self.pixel)
+            if self.pixel:
+                values = None
+                stats = ip.getPixelValues(pixels, {}, name, self.chunkRows)
+            else:
+                channelValues, gridRed = ip.channelMeans(pixels, self.nSquares)
+                values = channelValues[:, -1]
+                stats = ToneStats().update(values)
+                if meanRed is None:
+                    meanRed = gridRed
+
+            minTone, maxTone, toneInc = self.toneRange(stats)
+            clipRange = (minTone, maxTone) if self.clip else None
+            scaleNote, scale, midiNotes, musicNotes = ip.getScale(meanRed)
+            scaleDict = dict(zip(midiNotes, musicNotes))
+            toneLibrary = ip.setToneLib(midiNotes, musicNotes, minTone, toneInc)
+
+            csvFile = io.StringIO()
+            midiFile = io.BytesIO()
+            wavFile = io.BytesIO() if self.wav else None
+            gridImage = redImage = None
+            total = pixels.shape[0] * pixels.shape[1] if self.pixel else len(values)
+            compactor = ip.newCompactor(self.compact, total)
+            noteSeconds = noteSecondsFor(total, self.wav) if self.wav else None
+            channelCsv = channelMidi = None
+            if self.pixel:
+                audio = WavRenderer(wavFile, noteSeconds) if self.wav else None
+                tones = ip.writePixelOutputs(csvFile, midiFile, pixels, toneLibrary, scaleDict, scale, scaleNote,
+                                             name, self.chunkRows, clipRange, keepTones=True, audio=audio,
+                                             compactor=compactor)
+                if audio is not None:
+                    audio.close()
+            else:
+                # Empty cells are drawn in the grid image, but not played
+                cellValues = ip.dropEmptyCells(values)
+                luminance = cellValues if clipRange is None else np.clip(cellValues, *clipRange)
+                tones = ip.moveToneScale(luminance, toneLibrary, scaleDict, scale)
+                ip.writeCsvHeader(csvFile)
+                ip.writeMidiValues(csvFile, cellValues, tones, scaleDict, scaleNote)
+                ip.writeToneMidi(midiFile, name, tones, compactor)
+                if self.wav:
+                    writeWav(wavFile, tones, noteSeconds)
+                if self.channels:
+                    channelCsv = io.StringIO()
+                    channelMidi = io.BytesIO()
+                    ip.writeChannelOutputs(channelCsv, channelMidi, name, ip.dropEmptyCells(channelValues), tones,
+                                           scaleDict, self.clip)
+                if self.render != 'none':
+                    previewSize = self.previewSize if self.render == 'preview' else None
+                    gridImage, redImage = ip.renderGrid(
+                        pixels, values, self.nSquares, greyScale,
+                        mask=ip.gridMask(pixels.shape[0:2], self.nSquares, previewSize=previewSize),
+                        previewSize=previewSize)
+                values = cellValues
+
+        return SonifyResult(name, meanRed, values, tones, (minTone, maxTone, toneInc), scaleNote,
+                            csvFile.getvalue(), midiFile.getvalue(), gridImage, redImage,
+                            wavFile.getvalue() if self.wav else None,
+                            channelCsv.getvalue() if channelCsv else None,
+                            channelMidi.getvalue() if channelMidi else None,
+                            compactor.ratio() if compactor else None)
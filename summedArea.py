@@ -0,0 +1,151 @@
+"""
+Summed-area table (integral image) index of an image's luminance.
+
+The table is built once per image, after which the mean of any rectangular
+cell is four lookups, so extra grid layouts cost the same whatever the image
+size. Cells are (n, 4) arrays of [row start, row end, column start, column
+end], the createGrid layout, and may be any rectangles: uniform grids at
+several resolutions, non-uniform grids, quadtrees or cells in random order.
+
+    table = SummedAreaTable(image)
+    means = table.means(gridCells(edgesX, edgesY))
+"""
+import numpy as np
+
+from tiledImage import stripRows, iterStrips
+
+
+class SummedAreaTable:
+    """
+    Cumulative sums of the pixel channel totals, with a leading row and
+    column of zeros. Integer images are summed exactly in int64, so cell
+    means match gridMeans. squares also keeps the sums of squares, needed
+    for cell variances. The image is read a strip of rows at a time, so a
+    memory mapped image is never loaded whole.
+    """
+
+    def __init__(self, image, squares=False, tileBytes=64 * 1024 * 1024):
+        rows, cols = image.shape[:2]
+        self.shape = (rows, cols)
+        self.channels = image.shape[2] if image.ndim > 2 else 1
+        dtype = np.int64 if image.dtype.kind in 'ui' else np.float64
+        self.table = np.zeros((rows + 1, cols + 1), dtype=dtype)
+        self.squares = np.zeros((rows + 1, cols + 1), dtype=dtype) if squares else None
+
+        # 8 and 16 bit channel totals fit in int32, which is quicker to add up
+        totalType = np.int32 if dtype == np.int64 and image.itemsize <= 2 else dtype
+        for row, strip in iterStrips(image, stripRows(image, tileBytes)):
+            if strip.ndim > 2:
+                # Adding channels one at a time is much quicker than sum(axis=2)
+                totals = strip[:, :, 0].astype(totalType)
+                for channel in range(1, self.channels):
+                    totals += strip[:, :, channel]
+            else:
+                totals = strip.astype(totalType)
+            self._accumulate(self.table, row, totals)
+            if squares:
+                self._accumulate(self.squares, row, np.square(totals, dtype=dtype))
+
+    def _accumulate(self, table, row, totals):
+        # Cumulative sums of a strip, in place, carried on from the row above
+        block = table[row + 1:row + 1 + len(totals), 1:]
+        np.cumsum(totals, axis=1, out=block)
+        block[0] += table[row, 1:]
+        np.cumsum(block, axis=0, out=block)
+
+    def _lookup(self, table, cells):
+        x1, x2, y1, y2 = cells.T
+        return table[x2, y2] - table[x1, y2] - table[x2, y1] + table[x1, y1]
+
+    def clip(self, cells):
+        """
+        Returns cells as an int array clipped to the image
+        """
+        cells = np.array(cells, dtype=np.intp).reshape(-1, 4)
+        cells[:, :2] = np.clip(cells[:, :2], 0, self.shape[0])
+        cells[:, 2:] = np.clip(cells[:, 2:], 0, self.shape[1])
+        return cells
+
+    def areas(self, cells):
+        """
+        Returns the pixel count of each cell, after clipping
+        """
+        cells = self.clip(cells)
+        return np.maximum(cells[:, 1] - cells[:, 0], 0) * np.maximum(cells[:, 3] - cells[:, 2], 0)
+
+    def sums(self, cells):
+        """
+        Returns the sum of the pixel channel totals in each cell
+        """
+        cells = self.clip(cells)
+        empty = (cells[:, 1] <= cells[:, 0]) | (cells[:, 3] <= cells[:, 2])
+        return np.where(empty, 0, self._lookup(self.table, cells))
+
+    def means(self, cells):
+        """
+        Returns the mean luminance of each cell, averaged across channels as
+        gridMeans does. Empty cells are NaN.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums(cells).astype(np.float64) / (self.areas(cells) * self.channels)
+
+    def variances(self, cells):
+        """
+        Returns the luminance variance of the pixels in each cell. Needs the
+        table to have been built with squares.
+        """
+        if self.squares is None:
+            raise ValueError("The table was built without squares")
+        cells = self.clip(cells)
+        counts = self.areas(cells).astype(np.float64)
+        squares = np.where(counts > 0, self._lookup(self.squares, cells), 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self.sums(cells) / counts
+            variances = (squares / counts - means * means) / self.channels ** 2
+        # Rounding can leave tiny negative variances for flat cells
+        return np.maximum(variances, 0)
+
+
+def gridCells(edgesX, edgesY):
+    """
+    Returns the cells between consecutive row and column edges, in the same
+    order as createGrid. Edges need not be evenly spaced.
+    """
+    edgesX = np.asarray(edgesX, dtype=np.intp)
+    edgesY = np.asarray(edgesY, dtype=np.intp)
+    x1, y1 = np.meshgrid(edgesX[:-1], edgesY[:-1], indexing='ij')
+    x2, y2 = np.meshgrid(edgesX[1:], edgesY[1:], indexing='ij')
+    return np.column_stack([x1.ravel(), x2.ravel(), y1.ravel(), y2.ravel()])
+
+def quadtreeCells(table, maxDepth=6, minStd=8.0, minSize=2):
+    """
+    Returns quadtree cells covering the image: starting from the whole
+    image, cells whose luminance standard deviation is above minStd are
+    split in four, down to maxDepth levels or cells minSize pixels across.
+    Cells are returned in row, then column order of their corners.
+    """
+    rows, cols = table.shape
+    cells = np.array([[0, rows, 0, cols]], dtype=np.intp)
+    leaves = []
+    for depth in range(maxDepth):
+        x1, x2, y1, y2 = cells.T
+        split = (np.sqrt(table.variances(cells)) > minStd) & (x2 - x1 >= 2 * minSize) & (y2 - y1 >= 2 * minSize)
+        leaves.append(cells[~split])
+        if not split.any():
+            cells = cells[:0]
+            break
+        x1, x2, y1, y2 = cells[split].T
+        midX = (x1 + x2) // 2
+        midY = (y1 + y2) // 2
+        cells = np.concatenate([np.column_stack(quarter) for quarter in
+                                ((x1, midX, y1, midY), (x1, midX, midY, y2),
+                                 (midX, x2, y1, midY), (midX, x2, midY, y2))])
+    leaves.append(cells)
+    cells = np.concatenate(leaves)
+    return cells[np.lexsort((cells[:, 2], cells[:, 0]))]
+
+def shuffleCells(cells, seed=None):
+    """
+    Returns the cells in random order, as randomizeGrid did
+    """
+    return cells[np.random.default_rng(seed).permutation(len(cells))]
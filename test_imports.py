@@ -0,0 +1,28 @@
+"""
+Checks that importing imageProcessor stays fast and leaves heavy and
+optional dependencies to the code paths that use them.
+
+    python -m unittest test_imports
+"""
+import os
+import unittest
+
+import benchmark
+
+# Generous, so that only real regressions fail on a busy machine
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 500))
+
+
+class ImportBudgetTest(unittest.TestCase):
+
+    def testLazyModules(self):
+        seconds, loaded = benchmark.importTime(repeat=1)
+        self.assertEqual(loaded, [], "importing imageProcessor loaded {}".format(", ".join(loaded)))
+
+    def testImportTime(self):
+        seconds, loaded = benchmark.importTime()
+        self.assertLess(seconds * 1000, IMPORT_BUDGET_MS)
+
+
+if __name__ == "__main__":
+    unittest.main()
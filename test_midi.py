@@ -0,0 +1,78 @@
+"""
+Checks that the midiWriter encoder writes the same bytes as midiutil, which
+makeMidi keeps as the reference.
+
+    python -m unittest test_midi
+"""
+import io
+import unittest
+
+import numpy as np
+
+import imageProcessor as ip
+from midiWriter import MidiWriter
+
+
+def referenceMidi(tones):
+    """
+    Returns the midi file midiutil writes for tones, one every half beat
+    """
+    tempMIDI = ip.newMidi("test")
+    ip.addMidiNotes(tempMIDI, tones)
+    midiFile = io.BytesIO()
+    tempMIDI.writeFile(midiFile)
+    return midiFile.getvalue()
+
+def toneSequences():
+    """
+    Returns named tone arrays: empty, single, constant, alternating and random
+    """
+    random = np.random.default_rng(0)
+    return {'empty': np.array([], dtype=np.int64),
+            'single': np.array([60]),
+            'constant': np.full(500, 64),
+            'twoPitches': np.tile([60, 67], 300),
+            'repeats': np.repeat(random.integers(36, 84, 200), random.integers(1, 6, 200)),
+            'random': random.integers(0, 128, 3000)}
+
+
+class MidiWriterTest(unittest.TestCase):
+
+    def testToneMidi(self):
+        for name, tones in toneSequences().items():
+            with self.subTest(name):
+                midiFile = io.BytesIO()
+                ip.writeToneMidi(midiFile, "test", tones)
+                self.assertEqual(midiFile.getvalue(), referenceMidi(tones))
+
+    def testChunkedNotes(self):
+        for name, tones in toneSequences().items():
+            for chunk in (1, 7, 256):
+                with self.subTest(name, chunk=chunk):
+                    midiFile = io.BytesIO()
+                    writer = MidiWriter(midiFile, tempo=60)
+                    writer.startTrack("test")
+                    for start in range(0, len(tones), chunk):
+                        ip.addToneNotes(writer, tones[start:start + chunk], start)
+                    writer.close()
+                    self.assertEqual(midiFile.getvalue(), referenceMidi(tones))
+
+    def testEvents(self):
+        for name, tones in toneSequences().items():
+            with self.subTest(name):
+                # Each note ends as the next starts, so the note offs go first
+                count = len(tones)
+                times = np.concatenate([np.arange(count) * .5, np.arange(1, count + 1) * .5])
+                pitches = np.concatenate([tones, tones])
+                noteOn = np.arange(2 * count) < count
+                order = np.argsort(times, kind='stable')
+                midiFile = io.BytesIO()
+                writer = MidiWriter(midiFile, tempo=60)
+                writer.startTrack("test")
+                writer.addEvents(times[order], pitches[order], noteOn[order])
+                writer.close()
+                self.assertEqual(midiFile.getvalue(), referenceMidi(tones))
+
+
+if __name__ == "__main__":
+    unittest.main()
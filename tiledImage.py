@@ -0,0 +1,68 @@
+"""
+Opens large images as arrays that are read from disk a strip at a time.
+
+NPY files and raw dumps are memory mapped. Uncompressed TIFFs are memory
+mapped through tifffile, when it is installed. Anything else is decoded
+with PIL, which loads the whole image.
+"""
+import os
+import functools
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=1)
+def loadTifffile():
+    """
+    Returns the tifffile module, or None if it is not installed
+    """
+    try:
+        import tifffile
+        return tifffile
+    except ImportError:
+        return None
+
+def parseShape(shape):
+    """
+    Parses a 'rows,columns[,channels]' string into a shape tuple
+    """
+    return tuple(int(size) for size in shape.split(','))
+
+def openImageArray(fileName, rawShape=None, rawDtype='uint8'):
+    """
+    Returns an array for the image file without reading its pixels, where
+    the format allows. Raw dumps need rawShape as (rows, columns[, channels]).
+    """
+    extension = os.path.splitext(fileName)[1].lower()
+    if extension == '.npy':
+        return np.load(fileName, mmap_mode='r')
+
+    if extension == '.raw':
+        if rawShape is None:
+            raise ValueError("Raw image {} needs a shape".format(fileName))
+        return np.memmap(fileName, dtype=rawDtype, mode='r', shape=tuple(rawShape))
+
+    if extension in ('.tif', '.tiff') and loadTifffile() is not None:
+        try:
+            return loadTifffile().memmap(fileName, mode='r')
+        except ValueError:
+            # Compressed or tiled TIFFs cannot be memory mapped
+            pass
+
+    from PIL import Image
+    return np.array(Image.open(fileName))
+
+def stripRows(array, tileBytes=64 * 1024 * 1024):
+    """
+    Returns how many image rows fit in tileBytes
+    """
+    rowBytes = array.itemsize * int(np.prod(array.shape[1:]))
+    return max(1, tileBytes // rowBytes)
+
+def iterStrips(array, rows):
+    """
+    Yields (first row, strip) for consecutive strips of rows of the array,
+    each read into memory
+    """
+    for row in range(0, array.shape[0], rows):
+        yield row, np.asarray(array[row:row + rows])
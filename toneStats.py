@@ -0,0 +1,108 @@
+"""
+Running luminance statistics used to set the tone range.
+"""
+import numpy as np
+
+# One histogram bin per integer luminance, matching the int() truncation
+# used when luminance values are mapped to tones
+HISTOGRAM_BINS = 256
+
+
+class ToneStats:
+    """
+    Accumulates the min, max and a luminance histogram of the values seen so
+    far. Stats from separate images or workers can be merged, so the range
+    never needs the values themselves to be kept.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.minVal = np.inf
+        self.maxVal = -np.inf
+        self.histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+
+    def update(self, values):
+        """
+        Adds an array of luminance values. NaN values (empty grid cells)
+        are ignored.
+        """
+        values = np.asarray(values).ravel()
+        if values.dtype.kind == 'f':
+            values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+
+        self.count += len(values)
+        self.minVal = min(self.minVal, values.min().item())
+        self.maxVal = max(self.maxVal, values.max().item())
+
+        # Values outside 0-255 are counted in the first or last bin
+        if values.dtype == np.uint8:
+            bins = values
+        else:
+            bins = np.clip(np.trunc(values), 0, HISTOGRAM_BINS - 1).astype(np.intp)
+        self.histogram += np.bincount(bins, minlength=HISTOGRAM_BINS)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the values counted by another ToneStats
+        """
+        self.count += other.count
+        self.minVal = min(self.minVal, other.minVal)
+        self.maxVal = max(self.maxVal, other.maxVal)
+        self.histogram += other.histogram
+        return self
+
+    def copy(self):
+        """
+        Returns an independent copy of the stats
+        """
+        return ToneStats().merge(self)
+
+    def percentile(self, percent):
+        """
+        Returns the integer luminance below which percent of the values lie,
+        from the histogram
+        """
+        if not self.count:
+            raise ValueError("No luminance values have been added")
+        cumulative = np.cumsum(self.histogram)
+        return int(np.searchsorted(cumulative, self.count * percent / 100, side='left'))
+
+    def toneRange(self, clip=0):
+        """
+        Returns min, max and tone increment luminance values. When clip is
+        given, that percentage of values is dropped from each end of the
+        histogram, so outliers do not stretch the tone increment.
+        """
+        if not self.count:
+            raise ValueError("No luminance values have been added")
+        minTone = int(self.minVal)
+        maxTone = int(self.maxVal)
+        if clip:
+            minTone = max(minTone, self.percentile(clip))
+            maxTone = min(maxTone, max(minTone, self.percentile(100 - clip)))
+
+        # The tone increment
+        toneIncrement = (maxTone - minTone) / 12
+        return minTone, maxTone, toneIncrement
+
+    def toDict(self):
+        """
+        Returns the stats as plain values, for saving as json
+        """
+        return {'count': self.count, 'minVal': self.minVal, 'maxVal': self.maxVal,
+                'histogram': self.histogram.tolist()}
+
+    @classmethod
+    def fromDict(cls, data):
+        """
+        Rebuilds stats saved with toDict
+        """
+        stats = cls()
+        stats.count = data['count']
+        stats.minVal = data['minVal']
+        stats.maxVal = data['maxVal']
+        stats.histogram = np.array(data['histogram'], dtype=np.int64)
+        return stats